@@ -6,6 +6,7 @@ import argparse
 from pathlib import Path
 import gzip
 import xml.etree.ElementTree as ET
+from array import array
 import sys
 
 
@@ -73,148 +74,251 @@ def potential_baseline_crossing_users(df):
 	
 
 
-def matsim_events_reader(agents_list, events_file, output_dir):
+# Events marking a vehicle entering the next link of its route
+ROUTE_EVENT_TYPES = ('entered link', 'vehicle enters traffic')
+
+
+
+class RouteStore:
+	"""
+	Links entered by each vehicle, stored in CSR layout: vehicle i's route is
+	link_ids[offsets[i]:offsets[i + 1]], entered at times[offsets[i]:offsets[i + 1]].
+	Vehicles (sorted by ID) and links are int32 codes into vehicle_names and
+	link_names. Once add_trip_id_to_links has run, trip_ids holds the code into
+	trip_names of the trip each link belongs to (-1 if none).
+	"""
+
+	def __init__(self, vehicle_names, offsets, link_ids, times, link_names):
+		self.vehicle_names = vehicle_names
+		self.offsets = offsets
+		self.link_ids = link_ids
+		self.times = times
+		self.link_names = link_names
+		self.trip_ids = None
+		self.trip_names = None
+
+	# Vehicle code of every stored link
+	def vehicle_codes(self):
+		return np.repeat(np.arange(len(self.vehicle_names), dtype=np.int32), np.diff(self.offsets))
+
+	# Person ID of every vehicle, e.g. 'person_1_bike' -> 'person_1'
+	def persons(self):
+		return np.array(['_'.join(vehicle.split('_')[:2]) for vehicle in self.vehicle_names], dtype=object)
+
+	# Link codes and entry times of one vehicle's route
+	def route(self, vehicle):
+		i = np.searchsorted(self.vehicle_names, vehicle)
+		if i == len(self.vehicle_names) or self.vehicle_names[i] != vehicle:
+			return self.link_ids[:0], self.times[:0]
+		start, end = self.offsets[i], self.offsets[i + 1]
+		return self.link_ids[start:end], self.times[start:end]
+
+	# New store holding only the vehicles where vehicle_mask is True
+	def select(self, vehicle_mask):
+		counts = np.diff(self.offsets)
+		link_mask = np.repeat(vehicle_mask, counts)
+		offsets = np.zeros(np.count_nonzero(vehicle_mask) + 1, dtype=np.int64)
+		np.cumsum(counts[vehicle_mask], out=offsets[1:])
+
+		routes = RouteStore(self.vehicle_names[vehicle_mask], offsets, self.link_ids[link_mask], self.times[link_mask], self.link_names)
+		if self.trip_ids is not None:
+			routes.trip_ids = self.trip_ids[link_mask]
+			routes.trip_names = self.trip_names
+		return routes
+
+	# Strings are only built here, for exporting. With trips, links outside a trip are left out
+	def to_df(self, trips=True):
+		vehicle_codes = self.vehicle_codes()
+		df = pd.DataFrame({
+			'person': self.persons()[vehicle_codes],
+			'vehicle_id': self.vehicle_names[vehicle_codes],
+			'link_id': self.link_names[self.link_ids],
+			'time_id': self.times,
+		})
+		if trips and self.trip_ids is not None:
+			in_trip = self.trip_ids >= 0
+			df = df[in_trip].copy()
+			df.insert(2, 'trip_id', self.trip_names[self.trip_ids[in_trip]])
+			df['time_id'] = df['time_id'].astype(int)
+		return df
+
+
+
+# Streams the events file, keeping the links entered by the vehicles in
+# vehicles (or every vehicle if None). Each event is cleared once read, so
+# the XML tree is never held in memory.
+def read_routes(events_file, vehicles=None):
+
+	vehicle_codes = {}
+	link_codes = {}
+	event_vehicles = array('i')
+	event_links = array('i')
+	event_times = array('f')
+
+	with gzip.open(events_file, 'rb') as xml_input:
+		context = ET.iterparse(xml_input, events=('start', 'end'))
+		_, root = next(context)
+
+		for event, child in context:
+			if event != 'end' or child.tag != 'event':
+				continue
+
+			attrib = child.attrib
+			if attrib['type'] in ROUTE_EVENT_TYPES:
+				vehicle = attrib['vehicle']
+				if vehicles is None or vehicle in vehicles:
+					event_vehicles.append(vehicle_codes.setdefault(vehicle, len(vehicle_codes)))
+					event_links.append(link_codes.setdefault(attrib['link'], len(link_codes)))
+					event_times.append(float(attrib['time']))
+			root.clear()
+
+	# Recode vehicles in ID order and group each vehicle's links together. The
+	# stable sort keeps every route in the order the links were entered
+	vehicle_names = np.array(list(vehicle_codes), dtype=object)
+	order = np.argsort(vehicle_names, kind='stable')
+	rank = np.empty(len(order), dtype=np.int32)
+	rank[order] = np.arange(len(order), dtype=np.int32)
+	event_vehicles = rank[np.frombuffer(event_vehicles, dtype=np.intc)]
+	event_order = np.argsort(event_vehicles, kind='stable')
+
+	offsets = np.zeros(len(vehicle_names) + 1, dtype=np.int64)
+	np.cumsum(np.bincount(event_vehicles, minlength=len(vehicle_names)), out=offsets[1:])
+
+	return RouteStore(
+		vehicle_names[order],
+		offsets,
+		np.frombuffer(event_links, dtype=np.intc).astype(np.int32)[event_order],
+		np.frombuffer(event_times, dtype=np.float32)[event_order],
+		np.array(list(link_codes), dtype=object)
+	)
 
-	# read events file
-	print('# Decompressing zip file ...')
-		
-	xml_input = gzip.open(events_file, 'rb')
-	
-	print('# Opening EVENTS file ...')
-	
-	MATSim_events = ET.parse(xml_input)
-	root = MATSim_events.getroot()
 
-	# create empty list to store data later
-	agents_routeLink_time_list = []
 
+def matsim_events_reader(agents_list, events_file, output_dir):
 
 	print('# Reading and identifying the road links used by the previous identified agents...')
 
-	for child in root:
-		
-		type_event = (child.attrib['type'])
-		
-		if ((type_event == 'entered link') or (type_event == 'vehicle enters traffic')):
-			
-			vehicle = (child.attrib['vehicle'])
-			
-			if (vehicle in agents_list):
+	routes = read_routes(events_file, None if agents_list is None else set(agents_list))
 
-				temp_list = []
-			
-				vehicle_id = (child.attrib['vehicle'])
-				link_id = (child.attrib["link"])
-				time_id = (child.attrib["time"])
+	print('# Road links identified')
 
-				temp_list.append(vehicle_id)
-				temp_list.append(link_id)
-				temp_list.append(time_id)
-				
-				agents_routeLink_time_list.append(temp_list)
+	# Export only the bus routes as csv
+	is_bus = pd.Series(routes.vehicle_names, dtype=object).str.contains('bus').to_numpy(dtype=bool)
+	print('Exporting bus routes using the closed crossing in the baseline.')
+	export_df_to_csv(routes.select(is_bus).to_df()[['vehicle_id', 'link_id', 'time_id']], output_dir)
 
+	return routes
 
-	print('# Road links identified')
 
-	# sort the lists by first element ('vehicle_id') 
-	agents_routeLink_time_list = sorted(agents_routeLink_time_list, key=lambda x:x[0])
-	
-	# Create a datafrane
-	df_agents_ALL_routeLink_time = pd.DataFrame(agents_routeLink_time_list)
-	
-	df_agents_ALL_routeLink_time.columns =['vehicle_id','link_id', 'time_id']
-	
-	# Create a dataframe containing only bus routes
-	df_bus_routesOnly = df_agents_ALL_routeLink_time.loc[df_agents_ALL_routeLink_time['vehicle_id'].str.contains('bus')]
-	
-	# Export the dataframe as csv
-	print('Exporting bus routes using the closed crossing in the baseline.')
-	export_df_to_csv(df_bus_routesOnly, output_dir)
-	
 
-	# Create a new column with the person ID
-	df_agents_ALL_routeLink_time["person"] = df_agents_ALL_routeLink_time["vehicle_id"].str.split("_").str[:2].str.join("_")
+# Converts times as 'hh:mm:ss' (hours can go past 24) to seconds
+def times_to_seconds(times):
+	if len(times) == 0:
+		return np.zeros(0, dtype=np.int64)
+	hms = times.astype(str).str.split(':', expand=True).astype(int)
+	return (hms[0] * 3600 + hms[1] * 60 + hms[2]).to_numpy(dtype=np.int64)
 
-	
-	return df_agents_ALL_routeLink_time
 
 
+# Set the trip each route link belongs to, i.e. the trip of the vehicle's person whose departure and arrival times contain the link's entry time
+def assign_trips(routes, df_trips):
 
-def time_convert(x):
-	h,m,s = map(int,x.split(':'))
-	time_seconds = int(h) *3600 +int(m)*60 + int(s)
-	return int(float(time_seconds))
+	person_names, vehicle_persons = np.unique(routes.persons(), return_inverse=True)
 
+	trip_persons = pd.Index(person_names).get_indexer(df_trips['person'].astype(str))
+	dep_time = times_to_seconds(df_trips['dep_time'])
+	arr_time = dep_time + times_to_seconds(df_trips['trav_time'])
+	trip_names = df_trips['trip_id'].astype(str).to_numpy(dtype=object)
 
+	# Keep only the trips of persons in the routes, sorted by person then departure time
+	keep = np.flatnonzero(trip_persons >= 0)
+	keep = keep[np.lexsort((dep_time[keep], trip_persons[keep]))]
+	trip_persons, dep_time, arr_time, trip_names = trip_persons[keep], dep_time[keep], arr_time[keep], trip_names[keep]
 
+	# Each link belongs to the person's last trip departing at or before it, as long as it hasn't arrived yet
+	link_persons = vehicle_persons[routes.vehicle_codes()].astype(np.int64)
+	link_times = routes.times.astype(np.int64)
+	trips = np.searchsorted(trip_persons.astype(np.int64) << 32 | dep_time, link_persons << 32 | link_times, side='right') - 1
+	found = trips >= 0
+	found[found] = (trip_persons[trips[found]] == link_persons[found]) & (link_times[found] <= arr_time[trips[found]])
 
-# Identify those elements from list_1 that are not in list_2
-def add_trip_id_to_links(df_routes, df_trips, output_dir):
-	
-	df_trips['dep_time'] = df_trips['dep_time'].astype(str)
-	df_trips['trav_time'] = df_trips['trav_time'].astype(str)
+	routes.trip_ids = np.where(found, trips, -1).astype(np.int32)
+	routes.trip_names = trip_names
 
-	
-	# Update the dep_time and trav_time columns to seconds
-	df_trips['dep_time'] = df_trips.dep_time.apply(time_convert)
-	df_trips['trav_time'] = df_trips.trav_time.apply(time_convert)
-	# Create a new column for the arrival time of each trip
-	df_trips['arr_time'] = df_trips['dep_time'] + df_trips['trav_time']
-	
+	return routes
 
-	# Keep only relevant columns
-	df_trips = df_trips[['person', 'trip_id', 'dep_time', 'arr_time']]
 
-	# Create a new column with the person id
-	#df_routes["person"] = df_routes["vehicle_id"].str.split("_").str[:2].str.join("_")
 
-	# Merge both dataframes 'many-to-many'
-	df = pd.merge(df_routes, df_trips, on='person', validate = 'many_to_many')
-	
-	df['time_id'] = df['time_id'].astype(float).astype(int)
+def add_trip_id_to_links(routes, df_trips, output_dir):
 
-	# Keep only those columns where 'time_id' is between 'dep_time' and 'arr_time'
-	df = df[(df.time_id >= df.dep_time) & (df.time_id <= df.arr_time)]
+	assign_trips(routes, df_trips)
 
-	# keep only relevant columns
-	df = df[['person', 'vehicle_id', 'trip_id', 'link_id', 'time_id']]
-	
 	print('Exporting road links as csv')
 	# Export the dataframe as csv file:
-	export_df_to_csv(df, output_dir)
-	
-	return df
+	export_df_to_csv(routes.to_df()[['person', 'vehicle_id', 'trip_id', 'link_id', 'time_id']], output_dir)
+
+	return routes
 
 	
 
 
 
-# Identify those elements from list_1 that are not in list_2
-def compare_links(df_routes1, df_routes_2):
+# (vehicle, trip, link) of every link inside a trip, as codes into the shared vehicle, trip and link indexes, with the entry time
+def trip_links(routes, vehicles, trips, links):
+	in_trip = routes.trip_ids >= 0
+	return (
+		vehicles.get_indexer(routes.vehicle_names)[routes.vehicle_codes()[in_trip]],
+		trips.get_indexer(routes.trip_names)[routes.trip_ids[in_trip]],
+		links.get_indexer(routes.link_names)[routes.link_ids[in_trip]],
+		routes.times[in_trip]
+	)
 
-	print('Identifying the different followed links')
 
-	# Merge both dataframes based on columns: 'vehicle_id','link_id' and 'trip_id'
-	# Use the parameter indicator to return an extra column indicating which table the row was from ('left_only', 'right_only', 'both')
-	df_all = df_routes1.merge(df_routes_2.drop_duplicates(), on=['vehicle_id','link_id','trip_id'], 
-				   how='left', indicator=True)
-				   
-	#print(df_all.head(1))
-	#sys.exit()
 
-	# If value is 'left_only' it means that df_routes1 row was not matched with anything from df_routes2
-	df_different_used_links = df_all.loc[(df_all['_merge'] == 'left_only')].copy()
-	
-	# keep only relevant columns
-	df_different_used_links = df_different_used_links[['person_x', 'vehicle_id', 'trip_id', 'link_id', 'time_id_x']]
-	
-	# rename some of the columns:
-	df_different_used_links.rename(columns={'person_x': 'person', 'trip_id_x': 'trip_id', 'time_id_x': 'time_id', }, inplace=True)
+# Identify, for every (vehicle, trip), the links used in routes_1 but not in routes_2 and those used in routes_2 but not in routes_1.
+# Both directions come from one sort of the two runs' links together; each link is kept once, with the earliest time the vehicle entered it on that trip
+def compare_routes(routes_1, routes_2):
 
+	print('Identifying the different followed links')
+
+	vehicles = pd.Index(np.union1d(routes_1.vehicle_names, routes_2.vehicle_names))
+	trips = pd.Index(np.union1d(routes_1.trip_names, routes_2.trip_names))
+	links = pd.Index(np.union1d(routes_1.link_names, routes_2.link_names))
+
+	links_1 = trip_links(routes_1, vehicles, trips, links)
+	links_2 = trip_links(routes_2, vehicles, trips, links)
+	vehicle, trip, link, time = (np.concatenate(pair) for pair in zip(links_1, links_2))
+	run = np.repeat(np.array([1, 2], dtype=np.int8), [len(links_1[0]), len(links_2[0])])
+
+	# Sorted by (vehicle, trip, link, run, time), the first row of each (vehicle, trip, link, run) is the earliest entry
+	order = np.lexsort((time, run, link, trip, vehicle))
+	vehicle, trip, link, run, time = vehicle[order], trip[order], link[order], run[order], time[order]
+	same_link = np.zeros(len(order), dtype=bool)
+	same_link[1:] = (vehicle[1:] == vehicle[:-1]) & (trip[1:] == trip[:-1]) & (link[1:] == link[:-1])
+	first = ~(same_link & np.r_[False, run[1:] == run[:-1]])
+	vehicle, trip, link, run, time, same_link = vehicle[first], trip[first], link[first], run[first], time[first], same_link[first]
+
+	# A (vehicle, trip, link) now appears twice if it was used in both runs, so the links left on their own are the differences
+	only = ~same_link & ~np.r_[same_link[1:], False]
+
+	def different_links(mask):
+		# in vehicle then time order, as the routes are
+		order = np.lexsort((time[mask], vehicle[mask]))
+		vehicle_ids = vehicles.to_numpy(dtype=object)[vehicle[mask][order]]
+		return pd.DataFrame({
+			'person': np.array(['_'.join(vehicle_id.split('_')[:2]) for vehicle_id in vehicle_ids], dtype=object),
+			'vehicle_id': vehicle_ids,
+			'trip_id': trips.to_numpy(dtype=object)[trip[mask][order]],
+			'link_id': links.to_numpy(dtype=object)[link[mask][order]],
+			'time_id': time[mask][order].astype(int)
+		})
+
+	df_different_used_links_1 = different_links(only & (run == 1))
+	df_different_used_links_2 = different_links(only & (run == 2))
 
 	print('Identified')
 
-	return df_different_used_links
+	return df_different_used_links_1, df_different_used_links_2
 
 
 
@@ -279,7 +383,7 @@ def main(scenario_name: str, link_1: str, link_1_dir: str, link_2: str, link_2_d
 	
 	# REQUIRED INPUTS IN COMMAND LINE:: str, 
 	## INPUTS:
-	baseline_TB_usersID = Path(baseline_CrossingUsers_filepath)
+	baseline_TB_usersID = Path(baseline_CrossingUsers_filepath) if baseline_CrossingUsers_filepath else None
 	matsim_events_scenario = Path(scenario_events_filepath)
 	matsim_events_baseline = Path(baseline_events_filepath)
 	scenario_trips = Path(scenario_trips_filepath)
@@ -305,7 +409,9 @@ def main(scenario_name: str, link_1: str, link_1_dir: str, link_2: str, link_2_d
 	# Check if input files exist:
 	print('* Checking if input files exist:')
 	
-	Input_filePaths_list = [baseline_TB_usersID, matsim_events_scenario, matsim_events_baseline, scenario_trips, baseline_trips]
+	Input_filePaths_list = [matsim_events_scenario, matsim_events_baseline, scenario_trips, baseline_trips]
+	if baseline_TB_usersID:
+		Input_filePaths_list.append(baseline_TB_usersID)
 	
 	for inputPath in Input_filePaths_list:
 		if inputPath.exists():
@@ -331,18 +437,23 @@ def main(scenario_name: str, link_1: str, link_1_dir: str, link_2: str, link_2_d
 	
 	print('\n* Input files and output directories succesfully identified!\n\n')
 	
-	# Read the agents using the TB in both scenario and baseline
-	print('Importing file: ' + str(baseline_TB_usersID) + ' with information about the agents using the closed crossing: (' + scenario_name + ') in the baseline.')
-	df_baseline_Crossing_users = read_csv(baseline_TB_usersID)
+	if baseline_TB_usersID:
+		# Read the agents using the TB in both scenario and baseline
+		print('Importing file: ' + str(baseline_TB_usersID) + ' with information about the agents using the closed crossing: (' + scenario_name + ') in the baseline.')
+		df_baseline_Crossing_users = read_csv(baseline_TB_usersID)
 
-	# Get the agentsID of those that use the "Crossing" under analysis in the baseline but do not in the scenario. All other potential users (*_bike, *_car_passenger and *(car) need to be added to find them in the Scenario Events, as some agents might have changed the transport mode used!)
-	potentialVehicleUsers_list = potential_baseline_crossing_users(df_baseline_Crossing_users)
+		# Get the agentsID of those that use the "Crossing" under analysis in the baseline but do not in the scenario. All other potential users (*_bike, *_car_passenger and *(car) need to be added to find them in the Scenario Events, as some agents might have changed the transport mode used!)
+		potentialVehicleUsers_list = potential_baseline_crossing_users(df_baseline_Crossing_users)
+	else:
+		# Without the crossing users file every agent is compared
+		print('No file with the agents using the closed crossing given, comparing the routes of ALL agents.')
+		potentialVehicleUsers_list = None
 	
 	# Get the links used by the agents chosen in potentialVehicleUsers_list
 	print('Proccessing MATSim ' + scenario_name + ' Events file... ' + str(matsim_events_scenario))
-	df_scenario_routeLinks = matsim_events_reader(potentialVehicleUsers_list, matsim_events_scenario, Scenario_bus_routes_output)
+	scenario_routes = matsim_events_reader(potentialVehicleUsers_list, matsim_events_scenario, Scenario_bus_routes_output)
 	print('Proccessing MATSim BASELINE Events file... ' + str(matsim_events_baseline))
-	df_baseline_routeLinks = matsim_events_reader(potentialVehicleUsers_list, matsim_events_baseline, Baseline_bus_routes_output)
+	baseline_routes = matsim_events_reader(potentialVehicleUsers_list, matsim_events_baseline, Baseline_bus_routes_output)
 
 	# Read the agents trips:
 	print('Importing file: ' + str(scenario_trips) + ' with ALL simulated trips from: ' + scenario_name)
@@ -351,15 +462,13 @@ def main(scenario_name: str, link_1: str, link_1_dir: str, link_2: str, link_2_d
 	df_baseline_trips = read_csv(baseline_trips)
 
 	# Clean and update route dataframes, departure and arrival as seconds and new column with the trip_id to which each link belongs in the trips file
-	df_scenario_routeTrips_updated = add_trip_id_to_links(df_scenario_routeLinks, df_scenario_trips, scenario_chosen_agents_all_routes_output)
-	df_baseline_routeTrips_updated = add_trip_id_to_links(df_baseline_routeLinks, df_baseline_trips, baseline_chosen_agents_all_routes_output)
-
-	# Compare the links used by the agents in scenario and baseline
-	## Those links used in the scenario but not in the baseline:
-	df_new_used_links_in_scenario = compare_links(df_scenario_routeTrips_updated, df_baseline_routeTrips_updated)
+	add_trip_id_to_links(scenario_routes, df_scenario_trips, scenario_chosen_agents_all_routes_output)
+	add_trip_id_to_links(baseline_routes, df_baseline_trips, baseline_chosen_agents_all_routes_output)
 
+	# Compare the links used by the agents in scenario and baseline, giving
+	## Those links used in the scenario but not in the baseline and
 	## Those links used in the baseline but not in the scenario:
-	df_old_used_links_in_baseline = compare_links(df_baseline_routeTrips_updated, df_scenario_routeTrips_updated)
+	df_new_used_links_in_scenario, df_old_used_links_in_baseline = compare_routes(scenario_routes, baseline_routes)
 
 	# Export datasets as csv files:
 	print('New ALL followed road links in scenario exported as csv')
@@ -371,10 +480,10 @@ def main(scenario_name: str, link_1: str, link_1_dir: str, link_2: str, link_2_d
 	df_baseline_trips_using_closedBridge = df_old_used_links_in_baseline.loc[((df_old_used_links_in_baseline['link_id'] == link_1) | (df_old_used_links_in_baseline['link_id'] == link_2))].copy()
 
 	# These are the new links used by the agents to avoid the Tyne Bridge
-	keep_TB_altered_trips_only(df_new_used_links_in_scenario, df_baseline_trips_using_closedBridge, scenario_altered_trips_time_links_output, df_scenario_routeLinks, link_1, link_1_dir, link_2, link_2_dir)
+	keep_TB_altered_trips_only(df_new_used_links_in_scenario, df_baseline_trips_using_closedBridge, scenario_altered_trips_time_links_output, scenario_routes.to_df(trips=False), link_1, link_1_dir, link_2, link_2_dir)
 
 	# These are the links used by the agents in baseline when using the Tyne
-	keep_TB_altered_trips_only(df_old_used_links_in_baseline, df_baseline_trips_using_closedBridge, baseline_trips_usingTB_time_links_output, df_baseline_routeLinks, link_1, link_1_dir, link_2, link_2_dir)
+	keep_TB_altered_trips_only(df_old_used_links_in_baseline, df_baseline_trips_using_closedBridge, baseline_trips_usingTB_time_links_output, baseline_routes.to_df(trips=False), link_1, link_1_dir, link_2, link_2_dir)
 
 	
 	print('Process has finished. Check the results, amigo!')
@@ -415,8 +524,10 @@ if __name__ == "__main__":
 	
 	p.add_argument(
 		'--baseline_CrossingUsers_filepath',
-		required=True,
-		type=str
+		required=False,
+		default=None,
+		type=str,
+		help='(optional) Agents using the closed crossing in the baseline. If not given, the routes of ALL agents are compared'
 	)
 
 	p.add_argument(
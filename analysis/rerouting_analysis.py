@@ -0,0 +1,316 @@
+import pandas as pd
+import numpy as np
+import argparse
+import gzip
+import sys
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from agents_routeLinks_and_time_v7 import read_routes, assign_trips, times_to_seconds, read_csv, export_df_to_csv
+
+
+###########################################################################################################
+
+# Python code to analyse how ALL agents reroute around a set of closed network links (e.g. the links flooded in a flood_network output), comparing the EVENTS files of the baseline and a scenario.
+
+### Each EVENTS file is read once for every agent, so closing hundreds of links costs the same as closing two. Replaces running identify_agents_using_links_v3 and agents_routeLinks_and_time_v7 one after the other.
+
+## Outputs (2 CSV files):
+
+## CSV file with one row for each baseline trip that used at least one closed link, comparing it to the same trip in the scenario. Lengths need the MATSim network and are in metres, times are in seconds
+## --> Columns name: person;trip_id;baseline_vehicle_id;scenario_vehicle_id;closed_links;baseline_dep_time;baseline_trav_time;scenario_trav_time;trav_time_delta;baseline_length;scenario_length;detour_length
+
+## CSV file containing all network links followed in those trips, in both the baseline and the scenario
+## --> Columns name: run;person;vehicle_id;trip_id;link_id;time_id
+
+###########################################################################################################
+
+
+
+# Closed link IDs, given directly and/or read from a flood_network output (.csv or .parquet) as the links whose velocity drops to closed_velocity or below at any timestep
+def read_closed_links(closed_links=None, flooded_network_filepath=None, closed_velocity=0.0, velocity_keyword='velocity'):
+
+	links = set(closed_links or [])
+
+	if flooded_network_filepath:
+		flooded_network_filepath = Path(flooded_network_filepath)
+		if flooded_network_filepath.suffix == '.parquet':
+			df = pd.read_parquet(flooded_network_filepath)
+		else:
+			df = pd.read_csv(flooded_network_filepath)
+
+		velocity_cols = [col for col in df.columns if col.endswith('_' + velocity_keyword)]
+		closed = (df[velocity_cols] <= closed_velocity).any(axis=1)
+		links.update(df.loc[closed, 'ID'].astype(str))
+
+	return np.array(sorted(links), dtype=object)
+
+
+
+# Streams a MATSim network (.xml or .xml.gz), returning the length of each link indexed by link ID. Nodes and links are dropped once read
+def read_link_lengths(network_filepath):
+
+	lengths = {}
+	opener = gzip.open if str(network_filepath).endswith('.gz') else open
+
+	with opener(network_filepath, 'rb') as xml_input:
+		parents = []
+		for event, child in ET.iterparse(xml_input, events=('start', 'end')):
+			if event == 'start':
+				parents.append(child)
+				continue
+			parents.pop()
+			if child.tag == 'link':
+				lengths[child.attrib['id']] = float(child.attrib['length'])
+			if parents and child.tag in ('node', 'link'):
+				parents[-1].remove(child)
+
+	return pd.Series(lengths, dtype=float)
+
+
+
+# Links inside a trip as (trip, vehicle, link, time), with trips as codes into the shared trip index. Kept in route order
+def trip_links(routes, trips):
+	in_trip = routes.trip_ids >= 0
+	return (
+		trips.get_indexer(routes.trip_names)[routes.trip_ids[in_trip]],
+		routes.vehicle_codes()[in_trip],
+		routes.link_ids[in_trip],
+		routes.times[in_trip]
+	)
+
+
+
+# Compares the baseline and scenario routes of every trip that used a closed link in the baseline
+def rerouting_analysis(baseline_routes, scenario_routes, closed_links, df_baseline_trips, df_scenario_trips, link_lengths=None):
+
+	print('Identifying the trips using the closed links')
+
+	trips = pd.Index(np.union1d(baseline_routes.trip_names, scenario_routes.trip_names))
+	trip_names = trips.to_numpy(dtype=object)
+
+	baseline_links = trip_links(baseline_routes, trips)
+	scenario_links = trip_links(scenario_routes, trips)
+
+	# Baseline trips entering at least one closed link
+	is_closed = np.isin(baseline_routes.link_names, closed_links)
+	trip, vehicle, link, time = baseline_links
+	uses_closed = is_closed[link]
+	affected = np.unique(trip[uses_closed])
+	is_affected = np.zeros(len(trips), dtype=bool)
+	is_affected[affected] = True
+
+	df_closed = pd.DataFrame({'trip': trip[uses_closed], 'link_id': baseline_routes.link_names[link[uses_closed]]})
+	closed_used = df_closed.drop_duplicates().groupby('trip')['link_id'].agg(','.join)
+
+	print(str(len(affected)) + ' trips used the closed links in the baseline')
+
+	summary = {
+		'person': None,
+		'trip_id': trip_names[affected],
+		'closed_links': closed_used.reindex(affected).to_numpy(),
+	}
+	routes_dfs = []
+
+	for run, routes, (trip, vehicle, link, time), df_trips in (
+		('baseline', baseline_routes, baseline_links, df_baseline_trips),
+		('scenario', scenario_routes, scenario_links, df_scenario_trips)
+	):
+
+		# Only the links of the affected trips
+		keep = is_affected[trip]
+		trip, vehicle, link, time = trip[keep], vehicle[keep], link[keep], time[keep]
+
+		# The vehicle making each trip is the one entering its first link. Trips not made in the scenario are left empty
+		found, first = np.unique(trip, return_index=True)
+		vehicle_ids = pd.Series(routes.vehicle_names[vehicle[first]], index=found, dtype=object)
+		summary[run + '_vehicle_id'] = vehicle_ids.reindex(affected).to_numpy()
+
+		# Trip times from the trips file. Trips not made in the scenario are left empty
+		df_trips = df_trips.assign(trip_id=df_trips['trip_id'].astype(str)).drop_duplicates('trip_id').set_index('trip_id').reindex(trip_names[affected])
+		made = df_trips['trav_time'].notna().to_numpy()
+		trav_time = np.full(len(affected), np.nan)
+		trav_time[made] = times_to_seconds(df_trips['trav_time'][made])
+		summary[run + '_trav_time'] = trav_time
+		if run == 'baseline':
+			summary['person'] = df_trips['person'].astype(str).to_numpy(dtype=object)
+			summary['baseline_dep_time'] = times_to_seconds(df_trips['dep_time'])
+
+		# Route length as the sum of its links' lengths
+		length = np.full(len(affected), np.nan)
+		if link_lengths is not None:
+			link_length = link_lengths.reindex(routes.link_names).to_numpy()
+			routed = np.isin(affected, found)
+			length[routed] = np.bincount(trip, weights=link_length[link], minlength=len(trips))[affected[routed]]
+		summary[run + '_length'] = length
+
+		routes_dfs.append(pd.DataFrame({
+			'run': run,
+			'vehicle_id': routes.vehicle_names[vehicle],
+			'trip_id': trip_names[trip],
+			'link_id': routes.link_names[link],
+			'time_id': time.astype(int)
+		}))
+
+	df_summary = pd.DataFrame(summary)
+	df_summary['trav_time_delta'] = df_summary['scenario_trav_time'] - df_summary['baseline_trav_time']
+	df_summary['detour_length'] = df_summary['scenario_length'] - df_summary['baseline_length']
+	df_summary = df_summary[['person', 'trip_id', 'baseline_vehicle_id', 'scenario_vehicle_id', 'closed_links', 'baseline_dep_time', 'baseline_trav_time', 'scenario_trav_time', 'trav_time_delta', 'baseline_length', 'scenario_length', 'detour_length']]
+
+	df_routes = pd.concat(routes_dfs, ignore_index=True)
+	df_routes.insert(1, 'person', df_routes['trip_id'].map(pd.Series(df_summary['person'].to_numpy(), index=df_summary['trip_id'])))
+
+	print('Identified')
+
+	return df_summary, df_routes
+
+
+
+def main(scenario_name: str, baseline_events_filepath: str, scenario_events_filepath: str, baseline_trips_filepath: str, scenario_trips_filepath: str,
+	summary_output_filepath: str, routes_output_filepath: str, closed_links: list = None, flooded_network_filepath: str = None,
+	closed_velocity: float = 0.0, network_filepath: str = None):
+
+	print('')
+	print('###################################################################')
+	print('* Rerouting analysis of ' + scenario_name)
+
+	# Check if input files exist:
+	print('* Checking if input files exist:')
+
+	Input_filePaths_list = [baseline_events_filepath, scenario_events_filepath, baseline_trips_filepath, scenario_trips_filepath, flooded_network_filepath, network_filepath]
+
+	for inputPath in Input_filePaths_list:
+		if inputPath is None:
+			continue
+		if Path(inputPath).exists():
+			print('File ' + str(inputPath) + ' found.')
+		else:
+			print('\n*** File ' + str(inputPath) + ' was not found!. Check if the given path is correct and exists.\n')
+			sys.exit()
+
+	closed_links = read_closed_links(closed_links, flooded_network_filepath, closed_velocity)
+	if len(closed_links) == 0:
+		print('\n*** No closed links given! Use --closed_links and/or --flooded_network_filepath.\n')
+		sys.exit()
+	print('\n* ' + str(len(closed_links)) + ' closed links\n')
+
+	link_lengths = None
+	if network_filepath:
+		print('Reading link lengths from: ' + str(network_filepath))
+		link_lengths = read_link_lengths(network_filepath)
+
+	# One pass over each events file, for every agent
+	print('Proccessing MATSim BASELINE Events file... ' + str(baseline_events_filepath))
+	baseline_routes = read_routes(baseline_events_filepath)
+	print('Proccessing MATSim ' + scenario_name + ' Events file... ' + str(scenario_events_filepath))
+	scenario_routes = read_routes(scenario_events_filepath)
+
+	print('Importing file: ' + str(baseline_trips_filepath) + ' with ALL simulated trips from the baseline.')
+	df_baseline_trips = read_csv(baseline_trips_filepath)
+	print('Importing file: ' + str(scenario_trips_filepath) + ' with ALL simulated trips from: ' + scenario_name)
+	df_scenario_trips = read_csv(scenario_trips_filepath)
+
+	assign_trips(baseline_routes, df_baseline_trips)
+	assign_trips(scenario_routes, df_scenario_trips)
+
+	df_summary, df_routes = rerouting_analysis(baseline_routes, scenario_routes, closed_links, df_baseline_trips, df_scenario_trips, link_lengths)
+
+	print('Trips using the closed links exported as csv')
+	export_df_to_csv(df_summary, summary_output_filepath)
+	print('Baseline and scenario routes of those trips exported as csv')
+	export_df_to_csv(df_routes, routes_output_filepath)
+
+	print('Process has finished. Check the results, amigo!')
+
+
+if __name__ == "__main__":
+	p = argparse.ArgumentParser()
+
+	p.add_argument(
+		'--scenario_name',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--baseline_events_filepath',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--scenario_events_filepath',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--baseline_trips_filepath',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--scenario_trips_filepath',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--summary_output_filepath',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--routes_output_filepath',
+		required=True,
+		type=str
+	)
+
+	p.add_argument(
+		'--closed_links',
+		required=False,
+		default=None,
+		type=lambda s: [item.strip() for item in s.split(",")],
+		help='(optional) Closed link IDs as comma-separated values e.g. 13476,125708'
+	)
+
+	p.add_argument(
+		'--flooded_network_filepath',
+		required=False,
+		default=None,
+		type=str,
+		help='(optional) flood_network output (.csv or .parquet), its links with a velocity at or below --closed_velocity at any timestep are closed'
+	)
+
+	p.add_argument(
+		'--closed_velocity',
+		required=False,
+		default=0.0,
+		type=float,
+		help='Default=0, velocity in m/s at or below which a flooded link is closed'
+	)
+
+	p.add_argument(
+		'--network_filepath',
+		required=False,
+		default=None,
+		type=str,
+		help='(optional) MATSim network .xml or .xml.gz, for the route and detour lengths'
+	)
+
+	args = p.parse_args()
+
+	main(
+		scenario_name=args.scenario_name,
+		baseline_events_filepath=args.baseline_events_filepath,
+		scenario_events_filepath=args.scenario_events_filepath,
+		baseline_trips_filepath=args.baseline_trips_filepath,
+		scenario_trips_filepath=args.scenario_trips_filepath,
+		summary_output_filepath=args.summary_output_filepath,
+		routes_output_filepath=args.routes_output_filepath,
+		closed_links=args.closed_links,
+		flooded_network_filepath=args.flooded_network_filepath,
+		closed_velocity=args.closed_velocity,
+		network_filepath=args.network_filepath
+	)
@@ -0,0 +1,124 @@
+# Measures the start-up (import) cost of each CLI entry point, so that heavy
+# imports creeping back into module level show up. Each module is imported in
+# a fresh interpreter, the fastest of --repeat runs is kept, and the heaviest
+# imports are reported from python -X importtime.
+# Run from the repository root: python benchmarks/import_time.py
+
+import argparse
+import csv
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+ENTRY_POINTS = [
+    "flood_network",
+    "flood_network_changeEvents",
+    "generate_changeEvents",
+    "generate_CityCAT_inputs",
+    "generate_flood_rasters",
+    "input_validation",
+    "nc2citycat",
+    "nc2citycat_batch",
+    "tunnels_and_bridges",
+]
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def run_import(module):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, result
+
+
+# Imports made directly by the timed module (one level of nesting below it in
+# the -X importtime tree) by cumulative time in us
+def heaviest_imports(importtime_output, n=5):
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith("   ") and not name.startswith("     "):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def main(modules: list, repeat: int = 5, history_filepath: str = None):
+    baseline = min(run_import("sys")[0] for _ in range(repeat))
+    print(f"interpreter start-up: {baseline:.3f}s (subtracted below)\n")
+
+    rows = []
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            elapsed, result = run_import(module)
+            if result.returncode != 0:
+                error = result.stderr.strip().splitlines()[-1]
+                print(f"{module}: failed to import - {error}")
+                break
+            times.append(elapsed)
+        else:
+            seconds = max(min(times) - baseline, 0)
+            print(f"{module}: {seconds:.3f}s")
+            for cumulative, name in heaviest_imports(result.stderr):
+                print(f"    {cumulative / 1e6:.3f}s {name}")
+            rows.append((module, seconds))
+
+    if history_filepath:
+        history_filepath = Path(history_filepath)
+        new_file = not history_filepath.exists()
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip()
+        with open(history_filepath, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["date", "commit", "module", "seconds"])
+            now = datetime.now().isoformat(timespec="seconds")
+            for module, seconds in rows:
+                writer.writerow([now, commit, module, f"{seconds:.4f}"])
+        print("\nAppended to:", history_filepath)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--modules",
+        type=lambda s: [item.strip() for item in s.split(",")],
+        default=ENTRY_POINTS,
+        help="(optional) Comma-separated modules to time, default all CLI "
+             "entry points",
+        required=False
+    )
+    p.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="(optional) Default=5 Runs per module, the fastest is kept",
+        required=False
+    )
+    p.add_argument(
+        "--history_filepath",
+        type=str,
+        default=None,
+        help="(optional) CSV to append the results to, to track start-up "
+             "cost over time",
+        required=False
+    )
+    args = p.parse_args()
+
+    main(
+        modules=args.modules,
+        repeat=args.repeat,
+        history_filepath=args.history_filepath,
+    )
@@ -3,18 +3,14 @@
 # Inputs - cityCAT floodmap output directory, transport network
 
 import geopandas as gpd
-from exactextract import exact_extract
 from pathlib import Path
 import argparse
 import utils
+import input_validation
 import xml.etree.ElementTree as ET
 import pandas as pd
 from shapely.geometry import LineString
 
-# unreferenced but used by other packages
-import pyogrio  # for faster exporting
-import rasterio # for loading in rasters with exactextract
-
 
 def read_pt2_network(filepath, crs):
     tree = ET.parse(filepath)
@@ -90,6 +86,10 @@ def remove_false_positive_categories(df):
 
 
 def zonal_statistics(filepaths, network, statistic):
+    # imported here to keep start-up fast for runs which fail early
+    from exactextract import exact_extract
+    import rasterio  # unreferenced, for loading in rasters with exactextract
+
     print("calculating zonal statistics")
     ngdf = network[['ID', 'geometry']].copy()
     gdf = exact_extract(
@@ -147,6 +147,7 @@ def vehicle_velocity(gdf, link_depth):
     return gdf
 
 
+# geopandas imports pyogrio itself for engine="pyogrio"
 def export_gpkg(gdf, filepath):
     filepath = filepath.with_suffix(".gpkg")
     print("Exporting to file: ", filepath)
@@ -164,10 +165,18 @@ def export_csv(gdf, filepath):
     df.to_csv(filepath, index=False)
 
 
-def main(
+# Typed alternative to export_csv - keeps float velocities and missing values
+# as NaN, so generate_changeEvents can read it back without any parsing
+def export_parquet(gdf, filepath):
+    filepath = filepath.with_suffix(".parquet")
+    print("Exporting to file: ", filepath)
+    df = pd.DataFrame(gdf.drop(columns='geometry'))
+    df.to_parquet(filepath, index=False)
+
+
+def flooded_network(
     network_filepath: str,
     floodmap_dir: str,
-    output_dir: str,
     crs: str,
     network_from: str,
     network_buffer_factor: float,
@@ -176,9 +185,11 @@ def main(
 ):
 
     floodmap_dir = Path(floodmap_dir)
-    output_dir = Path(output_dir)
 
-    filepaths = list(floodmap_dir.glob("*.tif"))
+    # rasters already validated by input_validation are listed in its manifest
+    filepaths = input_validation.read_manifest(floodmap_dir)
+    if filepaths is None:
+        filepaths = list(floodmap_dir.glob("*.tif"))
 
     print("Preparing network")
     if network_from == "VIA":
@@ -191,9 +202,40 @@ def main(
     gdf = zonal_statistics(filepaths, gdf_network, depth_statistic)
     gdf = vehicle_velocity(gdf, depth_statistic)
 
+    return gdf
+
+
+def main(
+    network_filepath: str,
+    floodmap_dir: str,
+    output_dir: str,
+    crs: str,
+    network_from: str,
+    network_buffer_factor: float,
+    depth_statistic: str = "max",
+    excluded_modes: list = None,
+    export_formats: list = ("gpkg", "csv"),
+):
+
+    output_dir = Path(output_dir)
+
+    gdf = flooded_network(
+        network_filepath=network_filepath,
+        floodmap_dir=floodmap_dir,
+        crs=crs,
+        network_from=network_from,
+        network_buffer_factor=network_buffer_factor,
+        depth_statistic=depth_statistic,
+        excluded_modes=excluded_modes,
+    )
+
     output = output_dir / "flooded_network"
-    export_gpkg(gdf, output)
-    export_csv(gdf, output)
+    if "gpkg" in export_formats:
+        export_gpkg(gdf, output)
+    if "csv" in export_formats:
+        export_csv(gdf, output)
+    if "parquet" in export_formats:
+        export_parquet(gdf, output)
 
     print("Done")
 
@@ -251,6 +293,14 @@ if __name__ == "__main__":
         type=str,
         help="Default=max, for options see: https://isciences.github.io/exactextract/operations.html"
     )
+    p.add_argument(
+        "--export_formats",
+        type=lambda s: [item.strip() for item in s.split(",")],
+        default=["gpkg", "csv"],
+        help='Default=gpkg,csv Output formats as comma-separated values from '
+             'gpkg,csv,parquet',
+        required=False
+    )
     args = p.parse_args()
 
     main(
@@ -262,4 +312,5 @@ if __name__ == "__main__":
         network_buffer_factor= args.network_buffer_factor,
         depth_statistic=args.depth_statistic,
         excluded_modes=args.excluded_modes,
+        export_formats=args.export_formats,
     )
\ No newline at end of file
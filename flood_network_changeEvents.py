@@ -0,0 +1,219 @@
+# This script runs flood_network and generate_changeEvents in one go, passing
+# the flooded network straight to the networkChangeEvents writer in memory
+# rather than through the flooded_network CSV.
+# Inputs - cityCAT floodmap output directory, transport network
+
+from pathlib import Path
+import argparse
+import flood_network
+import generate_changeEvents
+
+
+def main(
+    network_filepath: str,
+    floodmap_dir: str,
+    output_dir: str,
+    crs: str,
+    network_from: str,
+    network_buffer_factor: float,
+    event_start_time: str,
+    depth_statistic: str = "max",
+    excluded_modes: list = None,
+    export_formats: list = (),
+    time_interval: str = None,
+    only_changes: bool = False,
+    compress: bool = False,
+    quantize_step: float = None,
+    quantize_fraction: float = None,
+    timesteps: str = None,
+    resample_interval: str = None,
+    resample_method: str = "min"
+):
+
+    output_dir = Path(output_dir)
+
+    gdf = flood_network.flooded_network(
+        network_filepath=network_filepath,
+        floodmap_dir=floodmap_dir,
+        crs=crs,
+        network_from=network_from,
+        network_buffer_factor=network_buffer_factor,
+        depth_statistic=depth_statistic,
+        excluded_modes=excluded_modes,
+    )
+
+    # optional intermediates, e.g. for checking in GIS software
+    output = output_dir / "flooded_network"
+    if "gpkg" in export_formats:
+        flood_network.export_gpkg(gdf, output)
+    if "parquet" in export_formats:
+        flood_network.export_parquet(gdf, output)
+
+    df = generate_changeEvents.drop_invalid_ids(gdf.drop(columns='geometry'), "ID")
+    generate_changeEvents.write_change_events(
+        df,
+        output_dir=output_dir,
+        event_start_time=event_start_time,
+        time_interval=time_interval,
+        flood_network_id_name="ID",
+        only_changes=only_changes,
+        freespeed_field="FRSPEED",
+        compress=compress,
+        quantize_step=quantize_step,
+        quantize_fraction=quantize_fraction,
+        timesteps=timesteps,
+        resample_interval=resample_interval,
+        resample_method=resample_method
+    )
+
+    print("Done")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        '--network_filepath',
+        required=True,
+        type=str
+    )
+    p.add_argument(
+        '--floodmap_dir',
+        required=True,
+        help='Directory path to floodmap .tif files',
+        type=str
+    )
+    p.add_argument(
+        '--output_dir',
+        required=False,
+        default=".",
+        type=str
+    )
+    p.add_argument(
+        '--crs',
+        required=True,
+        help='CRS EPSG code without "EPSG:" e.g. "27700"',
+        type=str
+    )
+    p.add_argument(
+        '--network_from',
+        required=False,
+        choices=['PT2', 'VIA'],
+        default='PT2',
+        type=str,
+        help='Default=PT2, where the network file was generated - either in'
+             ' PT2-matsim as an xml or in VIA as a shp/gpkg'
+    )
+    p.add_argument(
+        '--network_buffer_factor',
+        required=True,
+        type=float
+    )
+    p.add_argument(
+        "--excluded_modes",
+        type=lambda s: [item.strip() for item in s.split(",")],
+        default=None,
+        help='Modes to exclude as comma-separated values e.g. rail,bus,subway',
+        required=False
+    )
+    p.add_argument(
+        "--depth_statistic",
+        required=False,
+        default="max",
+        type=str,
+        help="Default=max, for options see: https://isciences.github.io/exactextract/operations.html"
+    )
+    p.add_argument(
+        "--export_formats",
+        type=lambda s: [item.strip() for item in s.split(",")],
+        default=[],
+        help='(optional) Also export the flooded network as comma-separated '
+             'values from gpkg,parquet',
+        required=False
+    )
+    p.add_argument(
+        '--event_start_time',
+        required=True,
+        type=str,
+        help="Event start time as format %%H:%%M:%%S (e.g. 12:00:00 for 12pm)"
+    )
+    p.add_argument(
+        '--time_interval',
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Interval time as format %%H:%%M:%%S. By default the "
+             "times are read from the floodmap filenames"
+    )
+    p.add_argument(
+        '--timesteps',
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Only use these T values, e.g. 0,3,6 or 0-12"
+    )
+    p.add_argument(
+        '--resample_interval',
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Coarser interval to resample to, as format "
+             "%%H:%%M:%%S (e.g. 00:15:00)"
+    )
+    p.add_argument(
+        '--resample_method',
+        required=False,
+        choices=['min', 'first'],
+        default='min',
+        type=str,
+        help="(optional) Default=min"
+    )
+    p.add_argument(
+        '--only_changes',
+        required=False,
+        action='store_true',
+        help='(optional) Only write events for links whose velocity changed'
+    )
+    p.add_argument(
+        '--compress',
+        required=False,
+        action='store_true',
+        help='(optional) Write networkChangeEvents.xml.gz'
+    )
+    quantize = p.add_mutually_exclusive_group()
+    quantize.add_argument(
+        '--quantize_step',
+        required=False,
+        default=None,
+        type=float,
+        help='(optional) Round velocities to multiples of this step in m/s'
+    )
+    quantize.add_argument(
+        '--quantize_fraction',
+        required=False,
+        default=None,
+        type=float,
+        help='(optional) Round velocities to multiples of this fraction of '
+             'each link\'s freespeed'
+    )
+    args = p.parse_args()
+
+    main(
+        network_filepath=args.network_filepath,
+        floodmap_dir=args.floodmap_dir,
+        output_dir=args.output_dir,
+        crs=args.crs,
+        network_from=args.network_from,
+        network_buffer_factor=args.network_buffer_factor,
+        event_start_time=args.event_start_time,
+        depth_statistic=args.depth_statistic,
+        excluded_modes=args.excluded_modes,
+        export_formats=args.export_formats,
+        time_interval=args.time_interval,
+        only_changes=args.only_changes,
+        compress=args.compress,
+        quantize_step=args.quantize_step,
+        quantize_fraction=args.quantize_fraction,
+        timesteps=args.timesteps,
+        resample_interval=args.resample_interval,
+        resample_method=args.resample_method
+    )
@@ -5,7 +5,6 @@ The process includes merging multiple green space shapefiles, clipping them to t
 handling MultiPolygon geometries, and exporting the data for use in CityCAT flood modelling.
 """
 
-import geopandas as gpd
 from citycatio import utils as citycat_utils
 from citycatio.inputs import GreenAreas, Buildings  # TODO: Find a way of installing without conda
 from pathlib import Path
@@ -13,34 +12,150 @@ import pandas as pd
 import argparse
 import utils
 import os
+import shutil
+import shapely
+import geopandas as gpd
+
+# files written by citycatio's GreenAreas/Buildings and for rainfall zones
+CITYCAT_FILENAMES = {
+    'greenspaces': 'GreenAreas.txt',
+    'buildings': 'Buildings.txt',
+    'rainfall': 'Rainfall.txt',
+}
+
+
+# Reduces polygon detail below what a CityCAT grid of cell_size can resolve:
+# optionally merges touching polygons (e.g. building parts) into one, then
+# simplifies each polygon to simplify_fraction * cell_size (keeping it
+# valid), and drops polygons smaller than min_area_fraction of a cell.
+def simplify_polygons(gdf, cell_size: float, simplify_fraction: float = 0.5,
+                      min_area_fraction: float = 0.1, merge: bool = False):
+    geoms = gdf.geometry.values
+    vertices_before = shapely.get_num_coordinates(geoms).sum()
+    features_before = len(gdf)
+
+    if merge:
+        parts = shapely.get_parts(shapely.union_all(geoms))
+        gdf = gpd.GeoDataFrame(geometry=parts, crs=gdf.crs)
+
+    simplified = shapely.simplify(
+        gdf.geometry.values, simplify_fraction * cell_size, preserve_topology=True
+    )
+    gdf = gdf.set_geometry(gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+    keep = ~shapely.is_empty(simplified) & (
+        shapely.area(simplified) >= min_area_fraction * cell_size ** 2
+    )
+    gdf = gdf[keep].reset_index(drop=True)
+
+    vertices_after = shapely.get_num_coordinates(gdf.geometry.values).sum()
+    print(f'simplified: {features_before} to {len(gdf)} polygons, '
+          f'{vertices_before} to {vertices_after} vertices '
+          f'({1 - vertices_after / max(vertices_before, 1):.0%} fewer)')
+    return gdf
+
+
+# Loads, clips and explodes one input file (tile) at a time
+def stream_tiles(filepaths, crs, mask=None, bbox=None, workers=4,
+                 simplify: dict = None):
+    for filepath in filepaths:
+        gdf = utils.load_gdf(filepath, crs, bbox=bbox)
+        if mask is not None:
+            gdf = utils.clip_gdf(gdf, mask, workers=workers)
+        gdf = gdf.explode(ignore_index=True)
+        if simplify:
+            gdf = simplify_polygons(gdf, **simplify)
+        yield gdf
+
+
+# Writes polygons in the CityCAT text format tile by tile, so only one tile is
+# held in memory. The format starts with the polygon count, so the polygon
+# lines go to a temporary file first and are copied in after the count.
+def write_streaming(tiles, filepath):
+    print('Streaming to file: ', filepath)
+    body_filepath = filepath.with_suffix('.body.tmp')
+    count = 0
+    with open(body_filepath, 'w') as body:
+        for tile in tiles:
+            if len(tile) == 0:
+                continue
+            s = citycat_utils.geoseries_to_string(tile.geometry)
+            body.write(s[s.index('\n') + 1:])
+            count += len(tile)
+            print(f'{count} polygons written')
+
+    with open(filepath, 'w') as f, open(body_filepath) as body:
+        f.write(f'{count}\n')
+        shutil.copyfileobj(body, f)
+    os.remove(body_filepath)
 
 
 def main(feature: str, feature_dir: str, output_dir: str,
-         crs: str, feature_ext: str, boundary_path: str = None):
+         crs: str, feature_ext: str, boundary_path: str = None,
+         workers: int = 4, processes: bool = False, stream: bool = False,
+         cell_size: float = None, simplify_fraction: float = 0.5,
+         min_area_fraction: float = 0.1, merge_polygons: bool = False):
 
     input_path = Path(feature_dir)
     output_dir = Path(output_dir)
     filepaths = list(input_path.glob(f"*{feature_ext}"))
 
-    gdfs = []
-    for filepath in filepaths:
-        gdfs.append(utils.load_gdf(filepath, crs))
-
-    print('processing')
-    gdf = pd.concat(gdfs, axis=0, ignore_index=True)
+    if not filepaths:
+        raise Exception(f"No {feature_ext} files found in {feature_dir}")
+    if merge_polygons and not cell_size:
+        raise Exception("merge_polygons requires cell_size")
+    # streamed tiles are merged one at a time, so polygons split across a
+    # tile edge would never be merged
+    if merge_polygons and stream:
+        raise Exception("merge_polygons cannot be used with stream")
 
+    # the boundary is loaded first so features outside its extent are
+    # filtered out while reading
+    mask = None
+    bbox = None
     if boundary_path:
         mask = utils.load_gdf(Path(boundary_path), crs)
-        gdf = gpd.clip(gdf, mask, keep_geom_type=False)
+        bbox = tuple(mask.total_bounds)
+
+    simplify = None
+    if cell_size:
+        simplify = dict(
+            cell_size=cell_size,
+            simplify_fraction=simplify_fraction,
+            min_area_fraction=min_area_fraction,
+            merge=merge_polygons,
+        )
+
+    if stream:
+        tiles = stream_tiles(filepaths, crs, mask, bbox, workers, simplify)
+        write_streaming(tiles, output_dir / CITYCAT_FILENAMES[feature])
+        print('Done')
+        return
+
+    if feature_ext == '.csv':
+        gdfs = []
+        for filepath in filepaths:
+            gdfs.append(utils.load_gdf(filepath, crs))
+        gdf = pd.concat(gdfs, axis=0, ignore_index=True)
+    else:
+        gdf = utils.load_gdfs(
+            filepaths, crs, workers=workers, processes=processes, bbox=bbox
+        )
+
+    print('processing')
+    if mask is not None:
+        gdf = utils.clip_gdf(gdf, mask, workers=workers)
 
     gdf = gdf.explode(ignore_index=True)
 
+    if simplify:
+        gdf = simplify_polygons(gdf, **simplify)
+
     if feature == 'greenspaces':
         GreenAreas(gdf).write(output_dir)
     elif feature == 'buildings':
         Buildings(gdf).write(output_dir)
     elif feature == 'rainfall':
-        with open(os.path.join(output_dir, 'Rainfall.txt'), 'w') as f:
+        with open(os.path.join(output_dir, CITYCAT_FILENAMES[feature]), 'w') as f:
             f.write(citycat_utils.geoseries_to_string(gdf.geometry))
 
     print('Done')
@@ -86,6 +201,57 @@ if __name__ == "__main__":
         help='CRS EPSG code without "EPSG:" e.g. "27700"',
         type=str
     )
+    p.add_argument(
+        '--workers',
+        required=False,
+        default=4,
+        help='(optional) Number of files loaded in parallel; default 4',
+        type=int
+    )
+    p.add_argument(
+        '--processes',
+        required=False,
+        action='store_true',
+        help='(optional) Load files in processes instead of threads'
+    )
+    p.add_argument(
+        '--stream',
+        required=False,
+        action='store_true',
+        help='(optional) Process and write one input file at a time to bound '
+             'memory use, for large buildings/greenspace layers'
+    )
+    p.add_argument(
+        '--cell_size',
+        required=False,
+        default=None,
+        help='(optional) CityCAT cell size in CRS units. If given, polygons '
+             'are simplified and small polygons dropped relative to it',
+        type=float
+    )
+    p.add_argument(
+        '--simplify_fraction',
+        required=False,
+        default=0.5,
+        help='(optional) Simplification tolerance as a fraction of the cell '
+             'size; default 0.5',
+        type=float
+    )
+    p.add_argument(
+        '--min_area_fraction',
+        required=False,
+        default=0.1,
+        help='(optional) Drop polygons smaller than this fraction of a cell\'s '
+             'area; default 0.1',
+        type=float
+    )
+    p.add_argument(
+        '--merge_polygons',
+        required=False,
+        action='store_true',
+        help='(optional) Merge touching polygons (e.g. building parts) before '
+             'simplifying. Requires --cell_size, not available with --stream'
+    )
     args = p.parse_args()
 
     main(
@@ -95,4 +261,11 @@ if __name__ == "__main__":
         crs=args.crs,
         feature_ext=args.feature_ext,
         boundary_path=args.input_dir_boundary,
+        workers=args.workers,
+        processes=args.processes,
+        stream=args.stream,
+        cell_size=args.cell_size,
+        simplify_fraction=args.simplify_fraction,
+        min_area_fraction=args.min_area_fraction,
+        merge_polygons=args.merge_polygons,
     )
\ No newline at end of file
@@ -1,9 +1,11 @@
 # This script generates a networkChangeEvents xml file
-# Inputs - flood_network CSV outputs
+# Inputs - flood_network CSV or Parquet outputs
 
 import re
+import gzip
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 import argparse
 
@@ -18,45 +20,209 @@ def write_headers(file):
 
 
 def load_df(filepath, id):
-    df = pd.read_csv(filepath)
+    if filepath.suffix == ".parquet":
+        df = pd.read_parquet(filepath)
+    else:
+        df = pd.read_csv(filepath)
+    return drop_invalid_ids(df, id)
+
+
+def drop_invalid_ids(df, id):
     df = df.drop_duplicates(id)
     return df[df[id].notna()]
 
 
-def calculate_time(time1, time2, time_format="%H:%M:%S"):
-    t1 = datetime.strptime(time1, time_format)
-    t2 = datetime.strptime(time2, time_format)
-
-    delta1 = timedelta(hours=t1.hour, minutes=t1.minute, seconds=t1.second)
-    delta2 = timedelta(hours=t2.hour, minutes=t2.minute, seconds=t2.second)
+def time_to_seconds(time, time_format="%H:%M:%S"):
+    t = datetime.strptime(time, time_format)
+    return t.hour * 3600 + t.minute * 60 + t.second
 
-    total_delta = delta1 + delta2
 
-    total_seconds = int(total_delta.total_seconds())
-    hours, remainder = divmod(total_seconds, 3600)
+def seconds_to_time(total_seconds):
+    hours, remainder = divmod(int(total_seconds), 3600)
     minutes, seconds = divmod(remainder, 60)
-
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
 
-# Sorts based on T value, e.g. R1_C1_T0_0min, R1_C1_T1_5min, ...
-def sort_filenames(files):
-    return sorted(files, key=lambda x: int(re.search(r'_T(\d+)_', x).group(1)))
+# Matches the timestep and its time in minutes, e.g. R1_C1_T3_15min_velocity
+TIMESTEP_PATTERN = re.compile(r"_T(?P<timestep>\d+)_(?P<time>\d+)min")
 
 
-def main(
-    flood_network_csv_filepath: str,
+# Sorts the velocity columns by T value and returns each column's offset in
+# seconds from the event start, read from the column names (so uneven or
+# missing timesteps are kept where they are). A fixed time_interval can be
+# given instead, in which case the columns are taken as evenly spaced.
+def build_timeline(columns, time_interval=None):
+    parsed = []
+    for column in columns:
+        match = TIMESTEP_PATTERN.search(column)
+        if not match:
+            raise Exception(f"Cannot read _T<timestep>_<time>min from column: {column}")
+        parsed.append((int(match.group("timestep")), int(match.group("time")) * 60, column))
+    parsed.sort()
+
+    columns = [column for _, _, column in parsed]
+    timesteps = np.array([timestep for timestep, _, _ in parsed])
+    if time_interval:
+        offsets = np.arange(len(columns)) * time_to_seconds(time_interval)
+    else:
+        offsets = np.array([offset for _, offset, _ in parsed])
+    return columns, timesteps, offsets
+
+
+# Parses a timestep selection such as "0,3,6" or "0-12" (inclusive)
+def parse_timesteps(selection):
+    timesteps = set()
+    for item in selection.split(","):
+        item = item.strip()
+        if "-" in item:
+            first, last = item.split("-")
+            timesteps.update(range(int(first), int(last) + 1))
+        elif item:
+            timesteps.add(int(item))
+    return timesteps
+
+
+# Coarsens the timeline to a MATSim interval (seconds). Timesteps are binned
+# from the first offset; "min" keeps each link's slowest velocity in the bin
+# (the worst flooding), "first" keeps the timestep at the start of the bin.
+def resample_timeline(velocities, offsets, interval, method="min"):
+    bins = (offsets - offsets[0]) // interval
+    unique_bins, starts = np.unique(bins, return_index=True)
+    if method == "first":
+        resampled = velocities[:, starts]
+    elif method == "min":
+        resampled = np.fmin.reduceat(velocities, starts, axis=1)
+    else:
+        raise Exception(f"Unknown resample method: {method}")
+
+    print(f"resampled {len(offsets)} timesteps to {len(unique_bins)} at {interval}s intervals")
+    return resampled, offsets[0] + unique_bins * interval
+
+
+# Bins velocities so that links with similar speeds share one event. Either
+# to absolute steps (m/s) or to a fraction of each link's freespeed. Values
+# are rounded to the nearest bin, so the error is at most half a bin, and are
+# never raised above the link's freespeed. Velocities below the first bin are
+# left as they are rather than rounded down to 0, which would close the
+# link, as are links with no usable step (e.g. a freespeed of 0).
+def quantize_velocities(velocities, step=None, fraction=None, freespeed=None):
+    if (step is None) == (fraction is None):
+        raise Exception("Quantization needs exactly one of step or fraction")
+
+    if fraction is not None:
+        if freespeed is None:
+            raise Exception("Quantizing by a fraction of freespeed needs the freespeed field")
+        if fraction <= 0:
+            raise Exception("Quantization fraction must be positive")
+        step = fraction * np.asarray(freespeed, dtype=float)[:, None]
+    elif step <= 0:
+        raise Exception("Quantization step must be positive")
+
+    step = np.broadcast_to(step, velocities.shape)
+    usable = np.isfinite(step) & (step > 0)
+    step = np.where(usable, step, 1.0)
+
+    # rounded again to drop floating point noise from the multiplication
+    quantized = np.round(np.round(velocities / step) * step, 6)
+    quantized = np.where((velocities > 0) & (quantized <= 0), velocities, quantized)
+    if freespeed is not None:
+        freespeed = np.asarray(freespeed, dtype=float)[:, None]
+        quantized = np.where(np.isclose(quantized, freespeed), freespeed, quantized)
+        quantized = np.minimum(quantized, freespeed)
+    quantized = np.where(usable, quantized, velocities)
+
+    error = np.abs(quantized - velocities)
+    max_error = np.nanmax(error) if np.any(~np.isnan(error)) else 0.0
+    print(f"quantization: {len(np.unique(velocities[~np.isnan(velocities)]))} distinct "
+          f"velocities reduced to {len(np.unique(quantized[~np.isnan(quantized)]))}, "
+          f"max speed error {max_error:.4f} m/s")
+    return quantized
+
+
+# Blanks out (NaN) every velocity which is unchanged from the link's previous
+# timestep so that only actual changes are grouped into events. Links start
+# at their network freespeed, so the first timestep only emits flooded links,
+# and a link returning to its freespeed gets a reset event with that value.
+# Missing velocities are skipped and the previous state carried forward.
+def detect_changes(velocities, freespeed):
+    velocities = velocities.copy()
+    previous = np.asarray(freespeed, dtype=float)
+    total = 0
+    for t in range(velocities.shape[1]):
+        current = velocities[:, t]
+        changed = ~np.isnan(current) & (current != previous)
+        previous = np.where(changed, current, previous)
+        current[~changed] = np.nan
+        total += changed.sum()
+
+    print(f"change detection: {total} link changes across {velocities.shape[1]} timesteps "
+          f"(of {velocities.size} link velocities)")
+    return velocities
+
+
+# Groups a links x timesteps velocity matrix into (timestep, velocity, links)
+# events with a single stable sort over the whole table, rather than one
+# groupby per timestep. Events come out ordered by timestep then velocity,
+# with links in their original order.
+def group_events(velocities):
+    timestep, link = np.nonzero(~np.isnan(velocities.T))
+    values = velocities.T[timestep, link]
+
+    # MATSim doesn't accept 0 speed - use very small alternative
+    values[values == 0] = 0.001
+
+    order = np.lexsort((values, timestep))
+    timestep, link, values = timestep[order], link[order], values[order]
+
+    starts = np.flatnonzero(
+        np.r_[True, (timestep[1:] != timestep[:-1]) | (values[1:] != values[:-1])]
+    )
+    ends = np.r_[starts[1:], len(values)]
+    for start, end in zip(starts, ends):
+        yield timestep[start], values[start].item(), link[start:end]
+
+
+def open_output(filepath):
+    if filepath.suffix == ".gz":
+        return gzip.open(filepath, "wt", encoding="UTF-8", compresslevel=6)
+    return open(filepath, "w", encoding="UTF-8", buffering=1024 * 1024)
+
+
+def write_events(writefile, events, start_times, link_ids):
+    link_refs = np.array([f'<link refId="{link}"/>\n' for link in link_ids], dtype=object)
+    count = 0
+    for t, value, links in events:
+        writefile.write(
+            f'<networkChangeEvent startTime="{start_times[t]}">\n'
+            + "".join(link_refs[links])
+            + f'<freespeed type="absolute" value="{value}"/>\n'
+            + "</networkChangeEvent>\n"
+        )
+        count += 1
+    return count
+
+
+# Writes networkChangeEvents from a flooded network table (one row per link,
+# one velocity column per timestep), whether loaded from file or in memory.
+def write_change_events(
+    df,
     output_dir: str,
     event_start_time: str,
-    time_interval: str,
+    time_interval: str = None,
     flood_network_id_name: str = "ID",
-    velocity_keyword: str = "velocity"
+    velocity_keyword: str = "velocity",
+    only_changes: bool = False,
+    freespeed_field: str = "FRSPEED",
+    compress: bool = False,
+    quantize_step: float = None,
+    quantize_fraction: float = None,
+    timesteps: str = None,
+    resample_interval: str = None,
+    resample_method: str = "min"
 ):
 
-    flood_network_csv_filepath = Path(flood_network_csv_filepath)
     output_dir = Path(output_dir)
 
-    df = load_df(flood_network_csv_filepath, flood_network_id_name)
     velocity_cols = [
         col for col in df.columns if col.endswith("_" + velocity_keyword)
     ]
@@ -64,36 +230,89 @@ def main(
     if len(velocity_cols) == 0:
         raise Exception(f"No fields found containing velocity_keyword: {velocity_keyword}")
 
-    if len(velocity_cols) > 1:
-        velocity_cols = sort_filenames(velocity_cols)
+    velocity_cols, steps, offsets = build_timeline(velocity_cols, time_interval)
 
-    with open(output_dir / "networkChangeEvents.xml", "w") as writefile:
-        write_headers(writefile)
-        current_time = event_start_time
+    if timesteps:
+        keep = np.isin(steps, list(parse_timesteps(timesteps)))
+        if not keep.any():
+            raise Exception(f"None of the selected timesteps were found: {timesteps}")
+        velocity_cols = [col for col, k in zip(velocity_cols, keep) if k]
+        offsets = offsets[keep]
 
-        for column in velocity_cols:
-            print(column)
-            grouped = df.groupby(column)
-            dfs = {value: df for value, df in grouped}
+    velocities = df[velocity_cols].to_numpy(dtype=float)
 
-            for value, data in dfs.items():
-                writefile.write(f'<networkChangeEvent startTime="{current_time}">\n')
-                links = data["ID"].to_list()
-                for link in links:
-                    writefile.write(f'<link refId="{link}"/>\n')
+    if resample_interval:
+        velocities, offsets = resample_timeline(
+            velocities, offsets, time_to_seconds(resample_interval), resample_method
+        )
 
-                # MATSim doesn't accept 0 speed - use very small alternative
-                if value == 0:
-                    value = 0.001
+    freespeed = df[freespeed_field] if freespeed_field in df.columns else None
 
-                writefile.write(f'<freespeed type="absolute" value="{value}"/>\n')
-                writefile.write("</networkChangeEvent>\n")
+    if quantize_step is not None or quantize_fraction is not None:
+        velocities = quantize_velocities(
+            velocities, quantize_step, quantize_fraction, freespeed
+        )
 
-            # TODO: Calculate time interval automatically from column names
-            current_time = calculate_time(current_time, time_interval)
+    if only_changes:
+        if freespeed is None:
+            raise Exception(f"Change detection needs the freespeed field: {freespeed_field}")
+        velocities = detect_changes(velocities, freespeed)
 
+    start = time_to_seconds(event_start_time)
+    start_times = [seconds_to_time(start + offset) for offset in offsets]
+
+    output = output_dir / "networkChangeEvents.xml"
+    if compress:
+        output = output.with_suffix(".xml.gz")
+
+    print("Writing to file: ", output)
+    with open_output(output) as writefile:
+        write_headers(writefile)
+        events = group_events(velocities)
+        count = write_events(writefile, events, start_times, df[flood_network_id_name])
         writefile.write(f'</networkChangeEvents>\n')
 
+    print(f"{count} networkChangeEvents written")
+    return output
+
+
+def main(
+    flood_network_csv_filepath: str,
+    output_dir: str,
+    event_start_time: str,
+    time_interval: str = None,
+    flood_network_id_name: str = "ID",
+    velocity_keyword: str = "velocity",
+    only_changes: bool = False,
+    freespeed_field: str = "FRSPEED",
+    compress: bool = False,
+    quantize_step: float = None,
+    quantize_fraction: float = None,
+    timesteps: str = None,
+    resample_interval: str = None,
+    resample_method: str = "min"
+):
+
+    flood_network_csv_filepath = Path(flood_network_csv_filepath)
+
+    df = load_df(flood_network_csv_filepath, flood_network_id_name)
+    write_change_events(
+        df,
+        output_dir=output_dir,
+        event_start_time=event_start_time,
+        time_interval=time_interval,
+        flood_network_id_name=flood_network_id_name,
+        velocity_keyword=velocity_keyword,
+        only_changes=only_changes,
+        freespeed_field=freespeed_field,
+        compress=compress,
+        quantize_step=quantize_step,
+        quantize_fraction=quantize_fraction,
+        timesteps=timesteps,
+        resample_interval=resample_interval,
+        resample_method=resample_method
+    )
+
     print('Done')
 
 
@@ -102,7 +321,8 @@ if __name__ == "__main__":
     p.add_argument(
         '--flood_network_csv_filepath',
         required=True,
-        type=str
+        type=str,
+        help='flood_network output as .csv or .parquet'
     )
     p.add_argument(
         '--output_dir',
@@ -119,9 +339,36 @@ if __name__ == "__main__":
     )
     p.add_argument(
         '--time_interval',
-        required=True,
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Interval time as format %%H:%%M:%%S (e.g. 00:10:00 "
+             "for a 10 min interval). By default the times are read from the "
+             "_T<timestep>_<time>min part of the column names"
+    )
+    p.add_argument(
+        '--timesteps',
+        required=False,
+        default=None,
         type=str,
-        help="Interval time as format %%H:%%M:%%S (e.g. 00:10:00 for a 10 min interval)"
+        help="(optional) Only use these T values, e.g. 0,3,6 or 0-12"
+    )
+    p.add_argument(
+        '--resample_interval',
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Coarser interval to resample to, as format "
+             "%%H:%%M:%%S (e.g. 00:15:00)"
+    )
+    p.add_argument(
+        '--resample_method',
+        required=False,
+        choices=['min', 'first'],
+        default='min',
+        type=str,
+        help="(optional) Default=min, keep the slowest velocity in each "
+             "resampled interval or the first timestep"
     )
     p.add_argument(
         '--flood_network_id_name',
@@ -137,6 +384,44 @@ if __name__ == "__main__":
         type=str,
         help='(optional) Default=velocity'
     )
+    p.add_argument(
+        '--only_changes',
+        required=False,
+        action='store_true',
+        help='(optional) Only write events for links whose velocity changed '
+             'since the previous timestep (links start at their freespeed)'
+    )
+    p.add_argument(
+        '--freespeed_field',
+        required=False,
+        default="FRSPEED",
+        type=str,
+        help='(optional) Default=FRSPEED Name of the freespeed field, used '
+             'with --only_changes'
+    )
+    p.add_argument(
+        '--compress',
+        required=False,
+        action='store_true',
+        help='(optional) Write networkChangeEvents.xml.gz, which MATSim reads directly'
+    )
+    quantize = p.add_mutually_exclusive_group()
+    quantize.add_argument(
+        '--quantize_step',
+        required=False,
+        default=None,
+        type=float,
+        help='(optional) Round velocities to multiples of this step in m/s '
+             '(e.g. 0.5) so that more links share an event'
+    )
+    quantize.add_argument(
+        '--quantize_fraction',
+        required=False,
+        default=None,
+        type=float,
+        help='(optional) Round velocities to multiples of this fraction of '
+             'each link\'s freespeed (e.g. 0.1)'
+    )
     args = p.parse_args()
 
     main(
@@ -145,5 +430,13 @@ if __name__ == "__main__":
         event_start_time=args.event_start_time,
         time_interval=args.time_interval,
         flood_network_id_name=args.flood_network_id_name,
-        velocity_keyword=args.velocity_keyword
+        velocity_keyword=args.velocity_keyword,
+        only_changes=args.only_changes,
+        freespeed_field=args.freespeed_field,
+        compress=args.compress,
+        quantize_step=args.quantize_step,
+        quantize_fraction=args.quantize_fraction,
+        timesteps=args.timesteps,
+        resample_interval=args.resample_interval,
+        resample_method=args.resample_method
     )
\ No newline at end of file
@@ -1,30 +1,69 @@
 # generates .tif files from CityCAT .rsl outputs
 
-import pandas as pd
-import geopandas as gpd
+import numpy as np
+import os
 import rasterio
 from rasterio.transform import from_origin
 from rasterio.features import rasterize
-from shapely.geometry import Point
+import shapely
 from pathlib import Path
 import argparse
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def process_file(filepath: Path, output_path: Path, crs: str, cellsize: int):
+
+# .rsl files are a single whitespace separated header line (XCen YCen Depth
+# ...) followed by numeric rows. The parsed table is kept as a structured
+# array in a .npy sidecar next to the .rsl so later runs only memory-map it.
+# If the sidecar can't be written (e.g. a read-only results directory) the
+# parsed table is returned uncached.
+def load_rsl(filepath: Path, cache: bool = True):
+    sidecar = filepath.with_suffix('.npy')
+    if (
+        cache
+        and sidecar.exists()
+        and sidecar.stat().st_mtime >= filepath.stat().st_mtime
+    ):
+        return np.load(sidecar, mmap_mode='r')
+
+    with open(filepath) as f:
+        columns = f.readline().split()
+        data = np.loadtxt(f, dtype=np.float64, ndmin=2)
+
+    table = np.empty(len(data), dtype=[(col, np.float64) for col in columns])
+    for i, col in enumerate(columns):
+        table[col] = data[:, i]
+
+    if not cache:
+        return table
+
+    # write to a temporary name first so parallel workers never map a
+    # partially written sidecar
+    tmp = sidecar.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, table)
+        os.replace(tmp, sidecar)
+    except OSError as e:
+        print(f'Could not cache {sidecar.name}: {e}')
+        tmp.unlink(missing_ok=True)
+        return table
+    return np.load(sidecar, mmap_mode='r')
+
+
+def process_file(filepath: Path, output_path: Path, crs: str, cellsize: int,
+                 cache: bool = True):
     filename = filepath.stem
     print(f"Processing {filename}")
 
-    # Load dataframe
-    df = pd.read_csv(filepath, sep='\s+', header=0)
-    geometry = [Point(xy) for xy in zip(df['XCen'], df['YCen'])]
-    gdf = gpd.GeoDataFrame(df, geometry=geometry, crs=f"EPSG:{crs}")
+    table = load_rsl(filepath, cache)
+    x, y = table['XCen'], table['YCen']
 
     # Build raster
-    xmin, ymin, xmax, ymax = gdf.total_bounds
+    xmin, ymin, xmax, ymax = x.min(), y.min(), x.max(), y.max()
     width = int((xmax - xmin) / cellsize)
     height = int((ymax - ymin) / cellsize)
     transform = from_origin(xmin, ymax, cellsize, cellsize)
-    shapes = ((geom, val) for geom, val in zip(gdf.geometry, gdf['Depth']))
+    shapes = zip(shapely.points(x, y), table['Depth'])
     raster = rasterize(
         shapes=shapes,
         out_shape=(height, width),
@@ -43,14 +82,15 @@ def process_file(filepath: Path, output_path: Path, crs: str, cellsize: int):
         width=width,
         count=1,
         dtype=raster.dtype,
-        crs=gdf.crs,
+        crs=f"EPSG:{crs}",
         transform=transform,
     ) as dst:
         dst.write(raster, 1)
     print(f"Written {output_filepath}")
 
 
-def main(input_dir: str, output_dir: str, crs: str, cellsize: int, multithread: bool, workers: int):
+def main(input_dir: str, output_dir: str, crs: str, cellsize: int, multithread: bool, workers: int,
+         rsl_cache: bool = True):
     input_path = Path(input_dir)
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
@@ -59,7 +99,7 @@ def main(input_dir: str, output_dir: str, crs: str, cellsize: int, multithread:
     if multithread:
         print(f"Running in parallel mode with {workers} workers...")
         with ProcessPoolExecutor(max_workers=workers) as executor:
-            futures = [executor.submit(process_file, fp, output_path, crs, cellsize) for fp in filepaths]
+            futures = [executor.submit(process_file, fp, output_path, crs, cellsize, rsl_cache) for fp in filepaths]
             for future in as_completed(futures):
                 try:
                     future.result()
@@ -68,7 +108,7 @@ def main(input_dir: str, output_dir: str, crs: str, cellsize: int, multithread:
     else:
         print("Running in sequential mode...")
         for fp in filepaths:
-            process_file(fp, output_path, crs, cellsize)
+            process_file(fp, output_path, crs, cellsize, rsl_cache)
 
     print('Done')
 
@@ -107,6 +147,11 @@ if __name__ == "__main__":
         default=4,
         help='Number of worker processes if multithreading'
     )
+    parser.add_argument(
+        '--no_rsl_cache',
+        action='store_true',
+        help='Do not read or write the .npy sidecar cache next to each .rsl'
+    )
     args = parser.parse_args()
 
     main(
@@ -115,5 +160,6 @@ if __name__ == "__main__":
         crs=args.crs,
         cellsize=args.cellsize,
         multithread=args.multithread,
-        workers=args.workers
+        workers=args.workers,
+        rsl_cache=not args.no_rsl_cache
     )
\ No newline at end of file
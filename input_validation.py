@@ -1,5 +1,19 @@
 import re
 import os
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+
+# Regular expression pattern to match filenames like: "NewcastleBaseline50mm_T0_0min.tif"
+FILENAME_PATTERN = re.compile(
+    r"(?P<prefix>.+)_T(?P<timestep>\d+)_(?P<time>\d+)min\.(?P<extension>tif|tfw|tif\.aux\.xml)"
+)
+
+# Written next to the rasters once they have been validated, so later steps
+# (e.g. flood_network) can take the ordered file list from it rather than
+# listing the directory again
+MANIFEST_FILENAME = "flood_rasters_manifest.json"
 
 
 def network(filepath):
@@ -8,70 +22,162 @@ def network(filepath):
         raise Exception("No network found - check your input path")
 
 
-def floodRasters(filepath):
+# Lists the directory once and parses every filename, returning the rasters
+# (.tif) sorted by timestep as dicts of filename, prefix, timestep and time.
+# World files and .aux.xml sidecars are checked for their name only.
+def scan_flood_rasters(dirpath):
+    rasters = []
+    prefixes = set()
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.name == MANIFEST_FILENAME:
+                continue
+            match = FILENAME_PATTERN.fullmatch(entry.name)
+            if not match:
+                print(f"Invalid filename format: {entry.name}")
+                raise Exception("Filename validation failed.")
+            prefixes.add(match.group("prefix"))
+            if match.group("extension") == "tif":
+                rasters.append({
+                    "filename": entry.name,
+                    "prefix": match.group("prefix"),
+                    "timestep": int(match.group("timestep")),
+                    "time": int(match.group("time")),
+                })
+
+    if not rasters:
+        raise Exception("No flood rasters found - check your input paths")
+    if len(prefixes) > 1:
+        print(f"Prefix mismatch between files: {sorted(prefixes)}")
+        raise Exception("Filename validation failed.")
+
+    rasters.sort(key=lambda raster: raster["timestep"])
+    return rasters
+
+
+def check_timesteps(rasters):
+    for prev_raster, curr_raster in zip(rasters, rasters[1:]):
+        if curr_raster["timestep"] != prev_raster["timestep"] + 1:
+            print(
+                f"Non-consecutive timestep between files: "
+                f"{prev_raster['filename']} and {curr_raster['filename']}")
+            raise Exception("Filename validation failed.")
+
+
+def read_header(filepath):
+    import rasterio
+
+    # opening only reads the header, no pixels are loaded
+    with rasterio.open(filepath) as src:
+        return {
+            "crs": src.crs.to_wkt() if src.crs else None,
+            "transform": list(src.transform.to_gdal()),
+            "dtypes": list(src.dtypes),
+            "shape": [src.count, src.height, src.width],
+        }
+
+
+# Reads every raster's header in a thread pool (GDAL releases the GIL) and
+# checks the CRS, transform, data type and shape all match the first raster
+def check_headers(dirpath, rasters, workers: int = 8):
+    filepaths = [Path(dirpath) / raster["filename"] for raster in rasters]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = list(executor.map(read_header, filepaths))
+
+    reference = headers[0]
+    for raster, header in zip(rasters, headers):
+        for key, value in header.items():
+            if value != reference[key]:
+                print(
+                    f"Raster {key} mismatch between files: "
+                    f"{rasters[0]['filename']} and {raster['filename']}")
+                raise Exception("Raster validation failed.")
+    return reference
+
+
+def write_manifest(dirpath, rasters, header=None):
+    manifest = {"rasters": rasters, "header": header}
+    # written in place rather than renamed in, so the manifest ends up newer
+    # than the directory's own modification time (see read_manifest)
+    with open(Path(dirpath) / MANIFEST_FILENAME, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+# Returns the raster filepaths sorted by timestep from the manifest, or None
+# if there isn't one or it's stale. Adding, removing or renaming a file
+# updates the directory's modification time, making it newer than the manifest.
+def read_manifest(dirpath):
+    dirpath = Path(dirpath)
+    manifest_filepath = dirpath / MANIFEST_FILENAME
+    try:
+        if manifest_filepath.stat().st_mtime_ns < dirpath.stat().st_mtime_ns:
+            return None
+        with open(manifest_filepath) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return [dirpath / raster["filename"] for raster in manifest["rasters"]]
+
+
+def floodRasters(filepath, headers: bool = False, workers: int = 8,
+                 manifest: bool = True):
     """
-    Validates a list of filenames based on the conditions:
+    Validates the flood rasters in a directory based on the conditions:
     1. Filenames must follow the pattern '<prefix>_T<timestep>_<time>min.<valid_extension>'.
-    2. Timesteps (T<number>) must be consecutive.
+    2. All files share the same prefix.
+    3. Timesteps (T<number>) of the .tif rasters must be consecutive.
+    4. (optional) The rasters' CRS, transform, data type and shape all match.
 
     Parameters:
-    filenames (list): List of filenames to validate.
+    filepath (str): Directory containing the flood rasters.
+    headers (bool): Also check each raster's header, without reading pixels.
+    workers (int): Threads used to read the headers.
+    manifest (bool): Write a manifest of the validated rasters to the directory.
 
     Returns:
-    bool: True if all files are valid, False otherwise.
+    bool: True if all files are valid, otherwise raises an Exception.
     """
 
-    if not os.listdir(filepath):
-        raise Exception("No flood rasters found - check your input paths")
-
-    # Regular expression pattern to match filenames like: "NewcastleBaseline50mm_T0_0min.tif"
-    FILENAME_PATTERN = re.compile(
-        r"(?P<prefix>.+)_T(?P<timestep>\d+)_(?P<time>\d+)min\.(?P<extension>tif|tfw|tif\.aux\.xml)"
-    )
+    rasters = scan_flood_rasters(filepath)
+    check_timesteps(rasters)
 
-    # Parse filenames
-    parsed_files = []
-
-    for filename in os.listdir(filepath):
-        match = FILENAME_PATTERN.match(filename)
-        if not match:
-            print(f"Invalid filename format: {filename}")
-            raise Exception("Filename validation failed.")
-        # Extract the parsed parts
-        prefix = match.group("prefix")
-        timestep = int(match.group("timestep"))
-        time = int(match.group("time"))
-        extension = match.group("extension")
-        parsed_files.append((filename, prefix, timestep, time, extension))
-
-        # Sort by timestep to check sequential order
-        parsed_files.sort(key=lambda x: x[2])  # Sort by timestep
-
-        # Check for sequential timesteps and validate filenames
-        for i in range(1, len(parsed_files)):
-            prev_file = parsed_files[i - 1]
-            curr_file = parsed_files[i]
-
-            # Check if the prefix is the same
-            if prev_file[1] != curr_file[1]:
-                print(
-                    f"Prefix mismatch between files: {prev_file[0]} and {curr_file[0]}")
-                raise Exception("Filename validation failed.")
+    header = check_headers(filepath, rasters, workers) if headers else None
 
-            # Check if timesteps are consecutive
-            if curr_file[2] != prev_file[2] + 1:
-                print(
-                    f"Non-consecutive timestep between files: {prev_file[0]} and {curr_file[0]}")
-                raise Exception("Filename validation failed.")
+    if manifest:
+        write_manifest(filepath, rasters, header)
 
-        print("All files are valid.")
-        return True
+    print("All files are valid.")
+    return True
 
 
-def main(filepath):
-    floodRasters(filepath + "/flood_rasters/")
+def main(filepath, headers: bool = False, workers: int = 8):
+    floodRasters(filepath + "/flood_rasters/", headers, workers)
     network(filepath + '/network.gpkg')
 
 
 if __name__ == "__main__":
-    main("")
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        '--input_dir',
+        required=False,
+        default="",
+        type=str,
+        help='Directory containing flood_rasters/ and network.gpkg'
+    )
+    p.add_argument(
+        '--headers',
+        required=False,
+        action='store_true',
+        help='(optional) Also check every raster\'s CRS, transform, data type '
+             'and shape match'
+    )
+    p.add_argument(
+        '--workers',
+        required=False,
+        default=8,
+        type=int,
+        help='Default=8, threads used to read raster headers'
+    )
+    args = p.parse_args()
+
+    main(args.input_dir, args.headers, args.workers)
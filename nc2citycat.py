@@ -2,33 +2,49 @@
 
 import numpy as np
 from netCDF4 import Dataset
-import matplotlib as mplt
-import cartopy.crs as ccrs
-import cartopy.feature as cfea
-import matplotlib.pyplot as plt
 from pathlib import Path
 import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-def write_headers(filepath, tttn, iii, caseid):
-    with open(filepath, 'w') as fcat:
-        fcat.write('* * *\n')
-        fcat.write('* * * rainfall * * *\n')
-        fcat.write('* * * case id: ' + caseid + '\n')
-        fcat.write(str(tttn) + '\n')
-        fcat.write('* * * ' + iii + '\n')
+# pole lon and lat values specific to UKCP-Local
+POLE_LONGITUDE = 177.5
+POLE_LATITUDE = 37.5
 
 
-def write_data(output_filepath, prec, seconds):
-    format2prec = ' '.join(' '.join('%0.12f' % x for x in y) for y in prec)
-    reshape = np.ravel(str(format2prec))
-    reshape = ' '.join(map(str, reshape))
-    with open(output_filepath, 'a') as fcat:
-        fcat.write(f"{seconds} {reshape}\n")
+def write_headers(fcat, tttn, iii, caseid):
+    fcat.write('* * *\n')
+    fcat.write('* * * rainfall * * *\n')
+    fcat.write('* * * case id: ' + caseid + '\n')
+    fcat.write(str(tttn) + '\n')
+    fcat.write('* * * ' + iii + '\n')
 
 
-def write_figure(output_dir, region, lat, lon, prec, ttt):
-    output = output_dir / str(ttt)
-    print('Plotting:', output)
+# Writes one row per timestep: the time in seconds followed by every cell of
+# that timestep's grid (row-major). prec is a (time, y, x) block.
+def write_data(fcat, prec, seconds):
+    rows = np.column_stack([seconds, prec.reshape(len(prec), -1)])
+    fmt = '%d' + ' %0.12f' * (rows.shape[1] - 1)
+    np.savetxt(fcat, rows, fmt=fmt)
+
+
+# Base maps (figure, axes and projection) keyed by region. Each process builds
+# its base map once, with the coastline/borders/states features, gridlines and
+# colorbar, and every frame only swaps the precipitation contours.
+_base_maps = {}
+
+# levels=[0,4,8,12,16,20,24,28,32,36,40] #,22,24,26,28,30]
+LEVELS = [0, 2, 4, 8, 16, 32, 64, 128]
+
+
+def base_map(region):
+    if region in _base_maps:
+        return _base_maps[region]
+
+    # plotting libraries are only imported when --plot is used
+    import matplotlib as mplt
+    import matplotlib.pyplot as plt
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfea
 
     domains = {
         "Newcastle": [-0.10, 1.00, 2.00, 2.90],
@@ -40,8 +56,9 @@ def write_figure(output_dir, region, lat, lon, prec, ttt):
     mplt.rc('xtick', labelsize=9)
     mplt.rc('ytick', labelsize=9)
 
-    # pole lon and lat values specific to UKCP-Local
-    projection = ccrs.RotatedPole(pole_longitude=177.5, pole_latitude=37.5)
+    projection = ccrs.RotatedPole(
+        pole_longitude=POLE_LONGITUDE, pole_latitude=POLE_LATITUDE
+    )
 
     fig = plt.figure(figsize=(5, 6))
     ax = fig.add_subplot(1, 1, 1, projection=projection)
@@ -52,56 +69,140 @@ def write_figure(output_dir, region, lat, lon, prec, ttt):
     ax.patch.set_facecolor('.9')
     ax.add_feature(cfea.LAND)
 
-    # levels=[0,4,8,12,16,20,24,28,32,36,40] #,22,24,26,28,30]
-    levels = [0, 2, 4, 8, 16, 32, 64, 128]
-    cmap = plt.cm.viridis_r
-    norm = mplt.colors.BoundaryNorm(levels, cmap.N)
-    # norm=mplt.colors.Normalize(vmin=None,vmax=None, clip=False)
-    # norm = mplt.colors.Normalize(vmin=0, vmax=1)
-    pc = ax.contourf(
-        lon, lat, prec[:, :], levels=levels, transform=projection,
-        cmap=cmap, norm=norm, extend='max'
-    )
-    # pc=ax.contourf(lon,lat,prec,levels=levels,transform=projection,cmap=cmap,norm=norm,extend='max')
-    # fig.colorbar(pc,extend='max', cax=ax_cb)
-    # fig.add_axes(ax_cb)
-
     ax.gridlines(draw_labels=True, dms=True, x_inline=False, y_inline=False,
                  color='black', linestyle='--')
 
     ttitle = 'Precipitation'
     ax.set_title(ttitle, loc='left', fontsize=12)
 
+    # the colorbar only depends on the levels, so it is drawn once from a
+    # standalone mappable rather than from each frame's contours
+    cmap = plt.cm.viridis_r
+    norm = mplt.colors.BoundaryNorm(LEVELS, cmap.N)
     fig.subplots_adjust(bottom=0.10)
     ax_cb1 = fig.add_axes([0.20, 0.08, 0.60, 0.011])
-    fig.colorbar(pc, cax=ax_cb1, orientation='horizontal')
+    fig.colorbar(
+        mplt.cm.ScalarMappable(norm=norm, cmap=cmap), cax=ax_cb1,
+        orientation='horizontal', extend='max'
+    )
     ax_cb1.tick_params(labelsize=12)
     ax_cb1.set_xlabel('Precipitation [$mm h^{-1}$]')
 
-    # ax_cb1d = fig.add_axes([0.439, 0.08, 0.15, 0.011])
-    # fig.colorbar(pc1d, cax=ax_cb1d, orientation='horizontal')
-    # ax_cb1d.tick_params(labelsize=12)
-    # ax_cb1d.set_xlabel('Change in lightning flashes [$km^{-2}$]')
+    fig.subplots_adjust(wspace=0.04, hspace=0.08)
+
+    _base_maps[region] = (fig, ax, projection, cmap, norm)
+    return _base_maps[region]
 
-    # plt.tight_layout()
-    plt.subplots_adjust(wspace=0.04, hspace=0.08)
 
-    plt.savefig(output.with_suffix('.png'))
+def write_figure(output_dir, region, lat, lon, prec, ttt):
+    output = output_dir / str(ttt)
+    print('Plotting:', output)
+
+    fig, ax, projection, cmap, norm = base_map(region)
+    pc = ax.contourf(
+        lon, lat, prec[:, :], levels=LEVELS, transform=projection,
+        cmap=cmap, norm=norm, extend='max'
+    )
+    fig.savefig(output.with_suffix('.png'))
+    pc.remove()
 
     formatprec = '\n'.join('\t'.join('%0.12f' % x for x in y) for y in prec)
     with open(output.with_suffix('.txt'), 'w') as f:
         f.write(str(formatprec))
 
-    # code piece below writes lats and lons for each file
-    #
-    # strlat=str(lat)
-    # strlon=str(lon)
-    # with open('mantest/'+caseid+strttt+'lat.txt', 'w') as f:
-    #    f.write(strlat)
-    # with open('mantest/'+caseid+strttt+'lon.txt', 'w') as f:
-    #    f.write(strlon)
+    return output.with_suffix('.png')
+
+
+# Renders frames in a process pool so plotting runs alongside the conversion.
+# At most max_pending frames are queued at once to bound memory.
+class FigureRenderer:
+    def __init__(self, output_dir, region, lat, lon, workers=4):
+        self.output_dir = output_dir
+        self.region = region
+        self.lat = lat
+        self.lon = lon
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = 2 * workers
+        self.pending = {}
+        self.frames = {}
+
+    def submit(self, prec, ttt):
+        if len(self.pending) >= self.max_pending:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        future = self.executor.submit(
+            write_figure, self.output_dir, self.region, self.lat, self.lon,
+            prec, ttt
+        )
+        self.pending[future] = ttt
+
+    def _collect(self, futures):
+        for future in futures:
+            ttt = self.pending.pop(future)
+            try:
+                self.frames[ttt] = future.result()
+            except Exception as e:
+                print(f"Error plotting timestep {ttt}: {e}")
+
+    def close(self):
+        self._collect(wait(self.pending).done)
+        self.executor.shutdown()
+        return [self.frames[ttt] for ttt in sorted(self.frames)]
+
+
+def write_animation(frames, output_filepath, fps=4):
+    from PIL import Image
+
+    print('Writing animation:', output_filepath)
+    images = [Image.open(frame) for frame in frames]
+    images[0].save(
+        output_filepath, save_all=True, append_images=images[1:],
+        duration=int(1000 / fps), loop=0
+    )
 
-    # precase(tttnum)=prec
+
+# Bounds of a CityCAT domain/boundary file in rotated-pole lon/lat, as
+# [min_lon, min_lat, max_lon, max_lat]. Without crs the file's own CRS is used.
+def domain_bbox(filepath, crs=None):
+    import cartopy.crs as ccrs
+    import utils
+
+    if crs:
+        boundary = utils.load_gdf(filepath, crs)
+    else:
+        boundary = utils.read_vector(filepath)
+        if boundary.crs is None:
+            raise Exception(f"{filepath} has no CRS - set it with --domain_crs")
+    projection = ccrs.RotatedPole(
+        pole_longitude=POLE_LONGITUDE, pole_latitude=POLE_LATITUDE
+    )
+    return boundary.to_crs(projection).total_bounds
+
+
+# Index range of the grid cells along one axis which overlap [low, high].
+# Cells are taken as extending half a grid spacing either side of their
+# centre coordinate.
+def axis_window(coords, low, high):
+    half = np.abs(np.diff(coords)).mean() / 2 if len(coords) > 1 else 0
+    inside = np.flatnonzero((coords + half >= low) & (coords - half <= high))
+    if len(inside) == 0:
+        raise Exception(f"Spatial window {low} to {high} is outside the grid "
+                        f"({coords.min()} to {coords.max()})")
+    return slice(int(inside.min()), int(inside.max()) + 1)
+
+
+# Returns the (grid_latitude, grid_longitude) slices to read for a rotated-pole
+# bbox, or the whole grid if no bbox is given
+def spatial_window(lat, lon, bbox=None):
+    if bbox is None:
+        return slice(None), slice(None)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    # UKCP grid longitudes are given in 0-360
+    lon = (np.asarray(lon) + 180) % 360 - 180
+    return (
+        axis_window(np.asarray(lat), min_lat, max_lat),
+        axis_window(lon, min_lon, max_lon),
+    )
 
 
 def main(
@@ -109,10 +210,16 @@ def main(
         output_dir: str,
         start_val: int,
         end_val: int,
-        ngrid: int,
         caseid: str,
         region: str = None,
         plot: bool = False,
+        chunk_size: int = 48,
+        bbox: list = None,
+        domain_filepath: str = None,
+        domain_crs: str = None,
+        plot_workers: int = 4,
+        animation: bool = False,
+        window: tuple = None,
 ):
 
     input_filepath = Path(input_filepath)
@@ -121,31 +228,55 @@ def main(
     output_dir.mkdir(parents=True, exist_ok=True)
     output = (output_dir / "Spatial_Rainfall_Data").with_suffix(".txt")
 
-    dosya = Dataset(input_filepath, 'r')
-
     ttt = start_val
     tttend = end_val
     tttilk = ttt
     tttn = tttend - ttt
 
-    iii = list(range(1, ngrid**2 + 1))
-    iii = ' '.join(map(str, iii))
-    write_headers(output, tttn, iii, caseid)
+    if domain_filepath and window is None:
+        bbox = domain_bbox(Path(domain_filepath), domain_crs)
 
-    while ttt < tttend:
-        tttnum = ttt - tttilk
-        seconds = 1800 * tttnum
+    with Dataset(input_filepath, 'r') as dosya, \
+            open(output, 'w', buffering=1024 * 1024) as fcat:
         lat = dosya.variables['grid_latitude'][:]
         lon = dosya.variables['grid_longitude'][:]
-        prec = (dosya.variables['precipitation_flux'][ttt, :, :])
-        prec *= 2.7777777777778E-7  # convert to m/s
+        precipitation_flux = dosya.variables['precipitation_flux']
 
-        write_data(output, prec, seconds)
+        # only the window is read from the file, and it sets the cell count.
+        # A window already computed for the same grid can be passed in.
+        ywin, xwin = window if window else spatial_window(lat, lon, bbox)
+        lat, lon = lat[ywin], lon[xwin]
+        print(f"Reading {len(lat)} x {len(lon)} cells")
 
-        if plot:
-            write_figure(output_dir, region, lat, lon, prec, ttt)
+        iii = list(range(1, len(lat) * len(lon) + 1))
+        iii = ' '.join(map(str, iii))
+        write_headers(fcat, tttn, iii, caseid)
 
-        ttt += 1
+        if plot:
+            renderer = FigureRenderer(output_dir, region, lat, lon, plot_workers)
+
+        # read the time series in blocks of chunk_size timesteps rather than
+        # one at a time
+        for ttt in range(tttilk, tttend, chunk_size):
+            tttstop = min(ttt + chunk_size, tttend)
+            prec = precipitation_flux[ttt:tttstop, ywin, xwin]
+            # scaled while still masked, as the masked multiply rounds
+            # differently to a plain float32 one
+            prec *= 2.7777777777778E-7  # convert to m/s
+            # masked (missing) cells are written as no rainfall
+            prec = np.ma.filled(prec, 0)
+            seconds = 1800 * np.arange(ttt - tttilk, tttstop - tttilk)
+
+            write_data(fcat, prec, seconds)
+
+            if plot:
+                for i, tttplot in enumerate(range(ttt, tttstop)):
+                    renderer.submit(prec[i], tttplot)
+
+    if plot:
+        frames = renderer.close()
+        if animation and frames:
+            write_animation(frames, output_dir / "Precipitation.gif")
 
     print("Done")
 
@@ -179,11 +310,32 @@ if __name__ == "__main__":
         required=True,
         type=int,
     )
+    window = p.add_mutually_exclusive_group()
+    window.add_argument(
+        '--bbox',
+        required=False,
+        default=None,
+        nargs=4,
+        type=float,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help="(optional) Only convert cells within this rotated-pole bbox, "
+             "e.g. --bbox -0.10 2.00 1.00 2.90"
+    )
+    window.add_argument(
+        '--domain_filepath',
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Only convert cells covering this CityCAT domain/"
+             "boundary shp/gpkg/csv/geojson file"
+    )
     p.add_argument(
-        '--ngrid',
-        required=True,
-        type=int,
-        help="provided value is squared to form a grid"
+        '--domain_crs',
+        required=False,
+        default=None,
+        type=str,
+        help='(optional) CRS EPSG code of --domain_filepath without "EPSG:" '
+             'e.g. "27700". Default is the CRS stored in the file'
     )
     p.add_argument(
         '--plot',
@@ -199,6 +351,27 @@ if __name__ == "__main__":
         help="Only required if plotting",
         default=None
     )
+    p.add_argument(
+        '--chunk_size',
+        required=False,
+        default=48,
+        type=int,
+        help="(optional) Default=48 Number of timesteps read from the NetCDF "
+             "file at once"
+    )
+    p.add_argument(
+        '--plot_workers',
+        required=False,
+        default=4,
+        type=int,
+        help="(optional) Default=4 Number of worker processes for plotting"
+    )
+    p.add_argument(
+        '--animation',
+        required=False,
+        action='store_true',
+        help="(optional) With --plot, also assemble the frames into a GIF"
+    )
     args = p.parse_args()
 
     main(
@@ -209,5 +382,10 @@ if __name__ == "__main__":
         caseid=args.caseid,
         start_val=args.start_val,
         end_val=args.end_val,
-        ngrid=args.ngrid,
+        chunk_size=args.chunk_size,
+        bbox=args.bbox,
+        domain_filepath=args.domain_filepath,
+        domain_crs=args.domain_crs,
+        plot_workers=args.plot_workers,
+        animation=args.animation,
     )
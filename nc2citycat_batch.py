@@ -0,0 +1,201 @@
+"Converts many UKCP NETCDF files (e.g. ensemble members / decades) to CityCAT Rainfall_Data in parallel"
+
+import csv
+import glob
+from netCDF4 import Dataset
+from pathlib import Path
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import nc2citycat
+
+
+# Reads a manifest CSV with the columns netcdf_filepath and caseid, plus
+# optional start_val and end_val overriding the batch defaults per file
+def read_manifest(filepath):
+    with open(filepath, newline='') as f:
+        return [row for row in csv.DictReader(f)]
+
+
+# One job per file matched by the glob, with the file name as its case id
+def jobs_from_glob(pattern):
+    filepaths = sorted(glob.glob(pattern))
+    return [
+        {'netcdf_filepath': fp, 'caseid': Path(fp).stem} for fp in filepaths
+    ]
+
+
+# Spatial window computed once from the first file's grid and reused for all
+# jobs - UKCP members and decades share the same grid
+def shared_window(filepath, bbox=None, domain_filepath=None, domain_crs=None):
+    if domain_filepath:
+        bbox = nc2citycat.domain_bbox(Path(domain_filepath), domain_crs)
+    with Dataset(filepath, 'r') as dosya:
+        lat = dosya.variables['grid_latitude'][:]
+        lon = dosya.variables['grid_longitude'][:]
+    return nc2citycat.spatial_window(lat, lon, bbox)
+
+
+def convert(job, output_dir, start_val, end_val, chunk_size, bbox, window):
+    nc2citycat.main(
+        input_filepath=job['netcdf_filepath'],
+        output_dir=output_dir,
+        start_val=int(job.get('start_val') or start_val),
+        end_val=int(job.get('end_val') or end_val),
+        caseid=job['caseid'],
+        chunk_size=chunk_size,
+        bbox=bbox,
+        window=window,
+    )
+    return job['caseid']
+
+
+def main(
+        output_dir: str,
+        start_val: int,
+        end_val: int,
+        netcdf_glob: str = None,
+        manifest_filepath: str = None,
+        chunk_size: int = 48,
+        bbox: list = None,
+        domain_filepath: str = None,
+        domain_crs: str = None,
+        reuse_window: bool = False,
+        workers: int = 4,
+):
+
+    if manifest_filepath:
+        jobs = read_manifest(manifest_filepath)
+    else:
+        jobs = jobs_from_glob(netcdf_glob)
+
+    if not jobs:
+        raise Exception("No NetCDF files found - check your glob or manifest")
+
+    window = None
+    if reuse_window:
+        window = shared_window(
+            jobs[0]['netcdf_filepath'], bbox, domain_filepath, domain_crs
+        )
+    elif domain_filepath:
+        bbox = nc2citycat.domain_bbox(Path(domain_filepath), domain_crs)
+
+    # memory per worker is bounded by chunk_size timesteps of the window
+    print(f"Converting {len(jobs)} files with {workers} workers...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                convert, job, output_dir, start_val, end_val, chunk_size,
+                bbox, window
+            ): job for job in jobs
+        }
+        failed = []
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                print(f"Converted {future.result()}")
+            except Exception as e:
+                print(f"Error converting {job['netcdf_filepath']}: {e}")
+                failed.append(job['netcdf_filepath'])
+
+    # the other files are still converted, but the batch must not exit 0
+    if failed:
+        raise Exception(f"{len(failed)} of {len(jobs)} conversions failed: "
+                        f"{', '.join(str(f) for f in failed)}")
+
+    print("Done")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    inputs = p.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        '--netcdf_glob',
+        type=str,
+        help="Glob of NetCDF files, e.g. 'ukcp/pr_rcp85_land-cpm_uk_2.2km_*.nc'."
+             " Each file's name is used as its case id"
+    )
+    inputs.add_argument(
+        '--manifest_filepath',
+        type=str,
+        help="CSV with the columns netcdf_filepath,caseid and optionally "
+             "start_val,end_val"
+    )
+    p.add_argument(
+        '--output_dir',
+        required=False,
+        default=".",
+        type=str
+    )
+    p.add_argument(
+        '--start_val',
+        required=True,
+        type=int,
+    )
+    p.add_argument(
+        '--end_val',
+        required=True,
+        type=int,
+    )
+    p.add_argument(
+        '--chunk_size',
+        required=False,
+        default=48,
+        type=int,
+        help="(optional) Default=48 Number of timesteps read from the NetCDF "
+             "file at once"
+    )
+    window = p.add_mutually_exclusive_group()
+    window.add_argument(
+        '--bbox',
+        required=False,
+        default=None,
+        nargs=4,
+        type=float,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help="(optional) Only convert cells within this rotated-pole bbox, "
+             "e.g. --bbox -0.10 2.00 1.00 2.90"
+    )
+    window.add_argument(
+        '--domain_filepath',
+        required=False,
+        default=None,
+        type=str,
+        help="(optional) Only convert cells covering this CityCAT domain/"
+             "boundary shp/gpkg/csv/geojson file"
+    )
+    p.add_argument(
+        '--domain_crs',
+        required=False,
+        default=None,
+        type=str,
+        help='(optional) CRS EPSG code of --domain_filepath without "EPSG:" '
+             'e.g. "27700". Default is the CRS stored in the file'
+    )
+    p.add_argument(
+        '--reuse_window',
+        required=False,
+        action='store_true',
+        help="(optional) Compute the spatial window once from the first file "
+             "and reuse it for every file (they must share the same grid)"
+    )
+    p.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of files converted in parallel'
+    )
+    args = p.parse_args()
+
+    main(
+        output_dir=args.output_dir,
+        start_val=args.start_val,
+        end_val=args.end_val,
+        netcdf_glob=args.netcdf_glob,
+        manifest_filepath=args.manifest_filepath,
+        chunk_size=args.chunk_size,
+        bbox=args.bbox,
+        domain_filepath=args.domain_filepath,
+        domain_crs=args.domain_crs,
+        reuse_window=args.reuse_window,
+        workers=args.workers,
+    )
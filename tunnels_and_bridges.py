@@ -1,62 +1,106 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import fiona
-from shapely.geometry import shape, LineString
-import pyogrio
+import shapely
+from pathlib import Path
+import utils
 
 # TODO:
 #  Custom OSM input to go into flood_network (write another script to deal with OSM, only extracting linestrings) osm_way_os = osm_id
 #  flood_network outputs to go into here
 
-# TODO: move to utils
-def load_shapefile(filepath, CRS):
-    print('loading shapefile:', filepath)
-    with fiona.open(filepath) as src:
-        geometries = [shape(feature['geometry']) for feature in src]
-        properties = [feature['properties'] for feature in src]
-    gdf = gpd.GeoDataFrame(properties, geometry=geometries)
-    return gdf.set_crs(CRS)
+# Applied while reading the network so other features are never decoded
+ROAD_RAIL_WHERE = "highway IS NOT NULL OR railway IS NOT NULL"
+
+
+# OSM tags parsed out of the hstore-style other_tags string, e.g.
+# "bridge"=>"yes","layer"=>"1". Flags are True when the tag is present and not
+# "no"; layer is an integer.
+OSM_FLAG_TAGS = ['tunnel', 'bridge', 'covered']
+OSM_INT_TAGS = ['layer']
+
+
+# Adds typed columns for OSM_FLAG_TAGS and OSM_INT_TAGS, parsing other_tags in
+# a single pass. With cache_filepath the parsed columns are stored as Parquet
+# and reused while the cache is newer than source_filepath.
+def parse_other_tags(gdf, cache_filepath=None, source_filepath=None):
+    tags = OSM_FLAG_TAGS + OSM_INT_TAGS
+    if cache_filepath:
+        cache_filepath = Path(cache_filepath)
+        if (
+            cache_filepath.exists()
+            and (source_filepath is None
+                 or cache_filepath.stat().st_mtime >= Path(source_filepath).stat().st_mtime)
+        ):
+            parsed = pd.read_parquet(cache_filepath)
+            if len(parsed) == len(gdf):
+                print('loading parsed OSM tags:', cache_filepath)
+                parsed.index = gdf.index
+                return gdf.assign(**{tag: parsed[tag] for tag in tags})
+
+    print('parsing OSM tags:', ', '.join(tags))
+    pairs = gdf['other_tags'].reset_index(drop=True).str.extractall(
+        r'"(?P<key>[^"]+)"=>"(?P<value>[^"]*)"'
+    )
+    pairs = pairs[pairs['key'].isin(tags)]
+    values = (
+        pairs.droplevel('match')
+        .set_index('key', append=True)['value']
+        .unstack()
+        .reindex(index=range(len(gdf)), columns=tags)
+    )
+
+    parsed = pd.DataFrame(index=values.index)
+    for tag in OSM_FLAG_TAGS:
+        parsed[tag] = values[tag].notna() & (values[tag] != 'no')
+    for tag in OSM_INT_TAGS:
+        parsed[tag] = pd.to_numeric(values[tag], errors='coerce').astype('Int16')
 
+    if cache_filepath:
+        print('caching parsed OSM tags:', cache_filepath)
+        parsed.to_parquet(cache_filepath)
 
-def extract_by_attributes(gdf):
-    print('extracting highway and railway attributes')
-    return gdf[gdf['highway'].notnull() | gdf['railway'].notnull()]
+    parsed.index = gdf.index
+    return gdf.assign(**{tag: parsed[tag] for tag in tags})
 
 
 def extract_asset(gdf, asset):
     print('extracting asset:', asset)
-    return gdf[gdf['other_tags'].str.contains(asset, na=False)]
+    return gdf[gdf[asset]]
 
 
-def extract_by_location(gdf1, gdf2):
+# Rows of gdf which cross any geometry in tree (a shapely STRtree), each kept
+# once and in their original order
+def extract_by_location(gdf, tree):
     print('extracting by location')
-    gdf1 = gdf1.set_crs(epsg=27700)  # TODO: Remove hard coding
-    gdf2 = gdf2.set_crs(epsg=27700)
-    gdf = (
-        gpd.sjoin(gdf1, gdf2, how="inner", predicate="crosses")
-        .rename(columns=lambda c: c[:-5] if c.endswith("_left") else c)
-        .loc[:, lambda df: ~df.columns.str.endswith("_right")]
-    )
-    return gdf[~gdf.index.duplicated(keep="first")]
+    gdf = gdf.set_crs(epsg=27700)  # TODO: Remove hard coding
+    crossing, _ = tree.query(gdf.geometry.values, predicate="crosses")
+    return gdf.iloc[np.unique(crossing)]
 
 
+# Splits every LineString into its two-point segments, repeating the link's
+# attributes for each segment. Built from the flat coordinate array in bulk
+# rather than one shapely object per segment in Python. MultiLineStrings are
+# split into their parts first, so no segment joins one part to the next.
 def explode_linestrings(gdf):
     print('exploding')
-
-    def segments(ls):
-        pts = list(ls.coords)
-        return [LineString(pts[i:i + 2]) for i in range(len(pts) - 1)]
-
-    return (
-        gdf
-        .assign(segments=gdf.geometry.apply(segments))
-        .explode(column='segments', index_parts=False)
-        .set_geometry('segments')
-        .drop(columns='geometry')
-        .rename_geometry('geometry')
-        .reset_index(drop=True)
+    parts, part_rows = shapely.get_parts(gdf.geometry.values, return_index=True)
+    counts = shapely.get_num_coordinates(parts)
+    coords = shapely.get_coordinates(parts, include_z=bool(shapely.has_z(parts).any()))
+
+    # every coordinate except the last of each part starts a segment
+    ends = np.cumsum(counts)
+    is_last = np.zeros(len(coords), dtype=bool)
+    is_last[ends[counts > 0] - 1] = True
+    seg_start = np.flatnonzero(~is_last)
+    segments = shapely.linestrings(
+        np.stack([coords[seg_start], coords[seg_start + 1]], axis=1)
     )
 
+    rows = np.repeat(part_rows, np.maximum(counts - 1, 0))
+    attributes = gdf.drop(columns=gdf.geometry.name).iloc[rows].reset_index(drop=True)
+    return gpd.GeoDataFrame(attributes, geometry=segments, crs=gdf.crs)
+
 
 def add_osm_attribute(gdf):
     print('adding new OSM attribute')
@@ -67,7 +111,7 @@ def add_osm_attribute(gdf):
 
 
 def remove_ids(gdf1, gdf2):
-    return gdf1[~gdf1["osm_id"].isin(set(gdf2["osm_id"].unique()))]
+    return gdf1[~gdf1["osm_id"].isin(gdf2["osm_id"])]
 
 
 def concatenate_ids(gdf1, gdf2):
@@ -81,18 +125,25 @@ def export_gpkg(gdf, filepath):
     gdf.to_file(filepath + ".gpkg", driver="GPKG", engine="pyogrio")
 
 
-def main(network_filepath):
-    network = load_shapefile(network_filepath, 27700)  # TODO: Remove hard coding
-    network_road_rail = extract_by_attributes(network)
+def main(network_filepath, tags_cache_filepath=None):
+    network_road_rail = utils.load_gdf(
+        network_filepath, 27700, where=ROAD_RAIL_WHERE, use_arrow=True
+    )  # TODO: Remove hard coding
+    network_road_rail = parse_other_tags(
+        network_road_rail, tags_cache_filepath, network_filepath
+    )
     network_tunnels = extract_asset(network_road_rail, 'tunnel')
     network_bridges = extract_asset(network_road_rail, 'bridge')
 
     # extract sections of links (not to be flooded) which are not labelled
-    # bridge but go over a tunnel (could be flooded)
-    network_tunnel_cross = extract_by_location(network_road_rail, network_tunnels)
+    # bridge but go over a tunnel (could be flooded). The tunnel tree is built
+    # once: first the links crossing a tunnel are found, then only the
+    # segments of those links are tested again.
+    tunnel_tree = shapely.STRtree(network_tunnels.geometry.values)
+    network_tunnel_cross = extract_by_location(network_road_rail, tunnel_tree)
     network_tunnel_exploded = explode_linestrings(network_tunnel_cross)
     network_tunnel_exploded = add_osm_attribute(network_tunnel_exploded) # TODO: this is reduntant if a new column is created
-    network_tunnel_sections = extract_by_location(network_tunnel_exploded, network_tunnels)
+    network_tunnel_sections = extract_by_location(network_tunnel_exploded, tunnel_tree)
 
     # bridges can't flood and so are removed
     vulnerable_links = remove_ids(network_road_rail, network_bridges)
@@ -1,58 +1,282 @@
-import pandas as pd
+import csv
+import hashlib
+import os
+import numpy as np
 import geopandas as gpd
-import fiona
 import shapely
-from shapely.geometry import shape
 from pathlib import Path
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+# Decoded layers can be cached as GeoParquet, keyed by the file's path, size
+# and modification time, the CRS and the read filters. Set GIS_CACHE_DIR (or
+# pass cache_dir) to enable; the least recently used layers are evicted once
+# the cache exceeds GIS_CACHE_MAX_BYTES (default 10 GB).
+CACHE_DIR = os.environ.get('GIS_CACHE_DIR')
+CACHE_MAX_BYTES = int(os.environ.get('GIS_CACHE_MAX_BYTES', 10 * 1024 ** 3))
 
-def load_gdf(filepath, crs: str):
+# files making up a shapefile, all of which affect what is loaded
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+# Filters for shp/gpkg/geojson are applied by pyogrio while reading, so
+# unwanted features and fields are never decoded:
+#   columns - list of fields to read (geometry is always read)
+#   where - SQL WHERE clause on the fields, e.g. "highway IS NOT NULL"
+#   bbox - (xmin, ymin, xmax, ymax) in the file's CRS
+#   mask - geometry/GeoDataFrame to intersect with (not with bbox)
+#   use_arrow - read through Arrow (needs pyarrow), faster for large layers
+#   cache_dir - GeoParquet cache directory, default GIS_CACHE_DIR. Not used
+#     with mask.
+def load_gdf(filepath, crs: str, columns: list = None, where: str = None,
+             bbox: tuple = None, mask=None, use_arrow: bool = False,
+             cache_dir: str = None):
     filepath = Path(filepath)
+    filters = dict(
+        columns=columns, where=where, bbox=bbox, mask=mask, use_arrow=use_arrow
+    )
+
+    cache_dir = cache_dir or CACHE_DIR
+    if not cache_dir or mask is not None:
+        return read_gdf(filepath, crs, **filters)
+
+    cache_dir = Path(cache_dir)
+    cached = cache_dir / (cache_key(filepath, crs, columns, where, bbox) + '.parquet')
+    if cached.exists():
+        print('loading cached:', filepath)
+        os.utime(cached)  # marks it as recently used
+        return gpd.read_parquet(cached)
+
+    gdf = read_gdf(filepath, crs, **filters)
+    write_cache(gdf, cached)
+    return gdf
+
+
+def read_gdf(filepath, crs, **filters):
     if filepath.suffix == '.shp':
-        return load_shapefile(filepath, crs)
+        return load_shapefile(filepath, crs, **filters)
     elif filepath.suffix == '.gpkg':
-        return load_geopackage(filepath, crs)
+        return load_geopackage(filepath, crs, **filters)
     elif filepath.suffix == '.csv':
         return load_csv(filepath, crs)
     elif filepath.suffix == '.geojson':
-        return load_geojson(filepath)
+        return load_geojson(filepath, **filters)
+
+
+def cache_key(filepath, crs, columns=None, where=None, bbox=None):
+    parts = [filepath.resolve(), crs, columns, where, bbox]
+    sources = [filepath]
+    if filepath.suffix == '.shp':
+        sources = [filepath.with_suffix(ext) for ext in SHAPEFILE_PARTS]
+    for source in sources:
+        if source.exists():
+            stat = source.stat()
+            parts += [source.name, stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def write_cache(gdf, cached):
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        gdf.to_parquet(tmp)
+    except Exception as e:
+        print(f'Could not cache {cached.name}: {e}')
+        tmp.unlink(missing_ok=True)
+        return
+    os.replace(tmp, cached)
+    evict_cache(cached.parent)
+
+
+# Deletes the least recently used cached layers until the cache fits max_bytes
+def evict_cache(cache_dir, max_bytes: int = None):
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    files = sorted(
+        (f.stat().st_mtime, f.stat().st_size, f)
+        for f in Path(cache_dir).glob('*.parquet')
+    )
+    total = sum(size for _, size, _ in files)
+    for _, size, f in files:
+        if total <= max_bytes:
+            break
+        print('evicting cached:', f.name)
+        f.unlink(missing_ok=True)
+        total -= size
+
+
+def read_vector(filepath, columns=None, where=None, bbox=None, mask=None,
+                use_arrow=False):
+    kwargs = dict(columns=columns, where=where, bbox=bbox, mask=mask)
+    kwargs = {key: value for key, value in kwargs.items() if value is not None}
+    return gpd.read_file(filepath, engine="pyogrio", use_arrow=use_arrow, **kwargs)
+
+
+def read_arrow(filepath, columns=None, where=None, bbox=None):
+    import pyogrio
+
+    meta, table = pyogrio.read_arrow(
+        filepath, columns=columns, where=where, bbox=bbox
+    )
+    return meta, table
+
+
+# Reads one file for load_gdfs as an Arrow table, with its geometry as WKB in
+# a 'geometry' column. With cache_dir the table is kept as Parquet, keyed as
+# for load_gdf's cache (the CRS is set after combining, so it isn't part of
+# the key), and later runs read that instead of decoding the file.
+def read_arrow_cached(filepath, columns=None, where=None, bbox=None,
+                      cache_dir=None):
+    import pyarrow.parquet as pq
+
+    filepath = Path(filepath)
+    if cache_dir:
+        cached = Path(cache_dir) / (
+            cache_key(filepath, None, columns, where, bbox) + '.arrow.parquet'
+        )
+        if cached.exists():
+            print('loading cached:', filepath)
+            os.utime(cached)  # marks it as recently used
+            return pq.read_table(cached)
+
+    meta, table = read_arrow(filepath, columns, where, bbox)
+    geometry_name = meta['geometry_name'] or 'wkb_geometry'
+    table = table.rename_columns([
+        'geometry' if name == geometry_name else name
+        for name in table.column_names
+    ])
+
+    if cache_dir:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            pq.write_table(table, tmp)
+            os.replace(tmp, cached)
+        except Exception as e:
+            print(f'Could not cache {cached.name}: {e}')
+            tmp.unlink(missing_ok=True)
+    return table
+
+
+# Loads many shp/gpkg/geojson files (e.g. MasterMap tiles) concurrently and
+# combines them into one GeoDataFrame. Each file is read by pyogrio into an
+# Arrow table - in threads by default, as GDAL releases the GIL while
+# reading, or in processes - and the tables are concatenated without copying
+# before a single conversion to pandas. bbox is pushed down to every read.
+# Each file's table is cached as for load_gdf (cache_dir, default
+# GIS_CACHE_DIR), with the cache evicted once all files are loaded.
+def load_gdfs(filepaths, crs: str, workers: int = 4, processes: bool = False,
+              columns: list = None, where: str = None, bbox: tuple = None,
+              cache_dir: str = None):
+    import pyarrow as pa
+
+    cache_dir = cache_dir or CACHE_DIR
+
+    print(f'loading {len(filepaths)} files with {workers} '
+          f'{"processes" if processes else "threads"}')
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        tables = list(executor.map(
+            read_arrow_cached, filepaths, repeat(columns), repeat(where),
+            repeat(bbox), repeat(cache_dir)
+        ))
+
+    if cache_dir:
+        evict_cache(cache_dir)
+
+    table = pa.concat_tables(
+        [table for table in tables if table.num_rows] or tables[:1],
+        promote_options="permissive"
+    )
+
+    geometry = shapely.from_wkb(
+        table['geometry'].to_numpy(zero_copy_only=False)
+    )
+    df = table.drop_columns(['geometry']).to_pandas()
+    gdf = gpd.GeoDataFrame(df, geometry=geometry)
+    return gdf.set_crs(crs, allow_override=True)
+
 
+# Equivalent to gpd.clip(gdf, mask, keep_geom_type=False), but only features
+# straddling the boundary get an intersection: an STRtree query drops the
+# disjoint features without geometry work, features the (prepared) boundary
+# covers are kept untouched, and the remaining intersections run in chunks
+# across threads (shapely releases the GIL).
+def clip_gdf(gdf, mask, workers: int = 4, chunk_size: int = 10000):
+    if mask.crs != gdf.crs:
+        mask = mask.to_crs(gdf.crs)
+    boundary = mask.geometry.union_all()
+    shapely.prepare(boundary)
 
-def load_shapefile(filepath, crs):
+    tree = shapely.STRtree(gdf.geometry.values)
+    candidates = np.sort(tree.query(boundary, predicate="intersects"))
+    geoms = np.asarray(gdf.geometry.values[candidates]).copy()
+
+    straddling = np.flatnonzero(~shapely.covers(boundary, geoms))
+    print(f'clipping: {len(gdf) - len(candidates)} features outside, '
+          f'{len(candidates) - len(straddling)} inside, '
+          f'{len(straddling)} on the boundary')
+
+    if len(straddling):
+        chunks = np.array_split(
+            geoms[straddling], -(-len(straddling) // chunk_size)
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = executor.map(
+                lambda chunk: shapely.intersection(chunk, boundary), chunks
+            )
+            geoms[straddling] = np.concatenate(list(parts))
+
+    clipped = gdf.iloc[candidates].copy()
+    clipped[gdf.geometry.name] = gpd.GeoSeries(geoms, index=clipped.index, crs=gdf.crs)
+    return clipped[~clipped.geometry.is_empty]
+
+
+def load_shapefile(filepath, crs, **filters):
     print('loading shapefile:', filepath)
-    with fiona.open(filepath) as src:
-        geometries = [shape(feature['geometry']) for feature in src]
-        properties = [feature['properties'] for feature in src]
-    gdf = gpd.GeoDataFrame(properties, geometry=geometries)
-    return gdf.set_crs(crs)
+    gdf = read_vector(filepath, **filters)
+    # the given CRS takes precedence over the .prj
+    return gdf.set_crs(crs, allow_override=True)
 
 
-def load_geopackage(filepath, crs):
+def load_geopackage(filepath, crs, **filters):
     print('loading geopackage:', filepath)
-    gdf = gpd.read_file(filepath)
+    gdf = read_vector(filepath, **filters)
     return gdf.set_crs(epsg=crs)
 
 
 def load_csv(filepath, crs):
     print('loading csv:', filepath)
-    df = pd.read_csv(filepath)
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
 
-    try:
-        return gpd.GeoDataFrame(
-            df,
-            geometry=gpd.points_from_xy(df.lon, df.lat),
-            crs=f"EPSG:{crs}"
+    # work out where the geometry is from the header alone, so the file is
+    # only parsed once
+    with open(filepath, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f), [])
+
+    if 'lon' in header and 'lat' in header:
+        column_types = {'lon': pa.float64(), 'lat': pa.float64()}
+    elif 'wkt_geom' in header:
+        column_types = {'wkt_geom': pa.string()}
+    else:
+        raise Exception(
+            f"No 'lat' 'lon' fields or 'wkt_geom' fields found in {filepath}"
         )
-    except Exception:
-        print("No 'lat' 'lon' fields found in csv, trying WKT")
 
-    try:
-        df["geometry"] = df["wkt_geom"].apply(shapely.wkt.loads)
-        return gpd.GeoDataFrame(df, geometry="geometry", crs=f"EPSG:{crs}")
-    except Exception:
-        print("No 'lat' 'lon' fields or 'wkt_geom' fields found in csv")
-        raise Exception
+    df = pa_csv.read_csv(
+        filepath,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types)
+    ).to_pandas()
+
+    if 'wkt_geom' in column_types:
+        geometry = shapely.from_wkt(df['wkt_geom'].to_numpy())
+    else:
+        geometry = gpd.points_from_xy(df['lon'].to_numpy(),
+                                      df['lat'].to_numpy())
+
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=f"EPSG:{crs}")
 
 
-def load_geojson(filepath):
-    return gpd.read_file(filepath)
\ No newline at end of file
+def load_geojson(filepath, **filters):
+    return read_vector(filepath, **filters)
\ No newline at end of file